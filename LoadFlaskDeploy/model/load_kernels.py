@@ -0,0 +1,191 @@
+"""
+CPU load kernels, each calibrated so that one unit of load_request takes about
+target_ms_per_unit milliseconds on this host.
+
+  python   the pure Python multiplication loop of model_util.load_function (holds the GIL)
+  numpy    small float64 matrix multiplies (vectorized, BLAS may use more than one core)
+  hashlib  sha256 over a 64 KiB buffer (releases the GIL, threads load cores in parallel)
+
+Calibrations are stored in calibration_file per CPU model and Python version, and reused by
+workers that start on any node with the same CPU and Python. Pod hostnames change with every
+restart, so they are not part of the key; calibration_file has to be on a persistent volume
+for the calibrations to outlive the pod.
+"""
+import abc
+import hashlib
+import json
+import os
+import platform
+import time
+
+import numpy as np
+
+import model_util as mu
+
+# milliseconds of CPU work per unit of load_request
+target_ms_per_unit = float(os.getenv("LOAD_MS_PER_UNIT", "1.0"))
+# kernel used when a request does not name one
+default_kernel = os.getenv("LOAD_KERNEL", "python")
+# calibrations measured before, per CPU model and Python version, so restarts skip the timing
+# runs; put it on a persistent volume, /tmp is gone when the pod is replaced
+calibration_file = os.getenv("LOAD_CALIBRATION_FILE", "/tmp/load_calibration.json")
+
+
+class LoadKernel(abc.ABC):
+    name = None
+
+    def __init__(self, scale):
+        self.scale = scale  # work per unit, in the kernel's own steps
+        self.ms_per_unit = None  # measured by calibrate
+        self.calibrated_at = None
+
+    @abc.abstractmethod
+    def work(self, steps):
+        """
+        :param steps: work in the kernel's own steps, scale of them make a unit
+        """
+
+    def run(self, n=1):
+        """
+        :param n: units, a fraction of a unit runs that fraction of the scale
+        :return: time in ms, units run, scale
+        """
+        n = max(float(n), 0.)
+        start_time = time.time()
+        for _ in range(int(n)):
+            self.work(self.scale)
+        self.work(int(round((n - int(n)) * self.scale)))
+        return 1000. * (time.time() - start_time), n, self.scale
+
+    def calibrate(self, target_ms=None, units=20, rounds=3, repeat=5):
+        """
+        Rescale until one unit takes about target_ms on this host
+        :return: calibration record
+        """
+        target_ms = target_ms or target_ms_per_unit
+        for _ in range(rounds):
+            self.ms_per_unit = self._measure(units, repeat)
+            self.scale = max(1, int(round(self.scale * target_ms / max(self.ms_per_unit, 1e-6))))
+        self.ms_per_unit = self._measure(units, repeat)
+        self.calibrated_at = time.time()
+        return self.calibration()
+
+    def _measure(self, units, repeat):
+        # median, a single run is easily thrown off by a noisy neighbour
+        return float(np.median([self.run(units)[0] / units for _ in range(repeat)]))
+
+    def calibration(self):
+        return {"kernel": self.name, "scale": self.scale, "ms_per_unit": self.ms_per_unit,
+                "target_ms_per_unit": target_ms_per_unit, "calibrated_at": self.calibrated_at}
+
+    def restore(self, record):
+        self.scale = record["scale"]
+        self.ms_per_unit = record["ms_per_unit"]
+        self.calibrated_at = record["calibrated_at"]
+
+
+class PythonLoopKernel(LoadKernel):
+    name = "python"
+
+    def __init__(self, scale=mu.LOAD_CALIBRATION_SCALE):
+        super().__init__(scale)
+
+    def work(self, steps):
+        mu.load_function(1, steps)
+
+
+class NumpyMatmulKernel(LoadKernel):
+    name = "numpy"
+
+    def __init__(self, scale=100, size=64):
+        super().__init__(scale)
+        self.a = np.full((size, size), mu.const_float)
+
+    def work(self, steps):
+        for _ in range(steps):
+            self.a @ self.a
+
+
+class HashlibKernel(LoadKernel):
+    name = "hashlib"
+
+    def __init__(self, scale=20, block_bytes=64 * 1024):
+        super().__init__(scale)
+        self.block = bytes(block_bytes)
+
+    def work(self, steps):
+        for _ in range(steps):
+            hashlib.sha256(self.block).digest()
+
+
+kernel_types = {k.name: k for k in [PythonLoopKernel, NumpyMatmulKernel, HashlibKernel]}
+kernels = {}
+
+
+def _cpu_model():
+    try:
+        with open("/proc/cpuinfo", "r") as infile:
+            for line in infile:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def calibration_key():
+    """
+    :return: what a calibration holds for: CPU model and interpreter
+    """
+    return f"{_cpu_model()}|{platform.python_implementation()} {platform.python_version()}"
+
+
+def _read_calibrations():
+    try:
+        with open(calibration_file, "r") as infile:
+            return json.load(infile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_calibrations(calibrations):
+    tmp_file_name = f"{calibration_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file_name, "w") as outfile:
+            json.dump(calibrations, outfile, indent=2)
+        os.replace(tmp_file_name, calibration_file)
+    except OSError:
+        pass  # read only file system, calibrate again next start
+
+
+def calibrate_kernels(refresh=False):
+    """
+    Build every kernel and calibrate it, run once when a worker starts; a calibration
+    stored for this CPU model, Python version and target is reused unless refresh
+    :return: {kernel name: calibration record}
+    """
+    calibrations = _read_calibrations()
+    stored = calibrations.get(calibration_key(), {})
+    for name, kernel_type in kernel_types.items():
+        kernel = kernel_type()
+        record = stored.get(name)
+        if not refresh and record is not None and record.get("target_ms_per_unit") == target_ms_per_unit:
+            kernel.restore(record)
+        else:
+            kernel.calibrate()
+        kernels[name] = kernel
+    res = {name: kernel.calibration() for name, kernel in kernels.items()}
+    if res != stored:
+        calibrations = _read_calibrations()  # another worker may have written meanwhile
+        calibrations[calibration_key()] = res
+        _write_calibrations(calibrations)
+    return res
+
+
+def get_kernel(name=None):
+    name = name or default_kernel
+    if name not in kernel_types:
+        raise ValueError(f"load_kernel should be one of {list(kernel_types)}")
+    if name not in kernels:
+        calibrate_kernels()
+    return kernels[name]
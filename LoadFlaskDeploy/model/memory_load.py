@@ -0,0 +1,145 @@
+"""
+Memory load: allocations of size MiB with a choice of backing and page touch pattern,
+optionally retained across requests.
+
+  backing  numpy      np.empty, the pages are committed as they are touched
+           anonymous  an anonymous mmap
+           file       an mmap of an unlinked file in MEMORY_LOAD_DIR, pages live in the page cache
+  touch    full        every byte written (np.ones, the original memory_function)
+           sequential  one byte per page, in address order
+           random      one byte per page, in random page order
+           sparse      one byte in a random touch_fraction of the pages
+
+Retained allocations stay in the worker's pool until their ttl passes or the pool is over
+its budget (oldest first); both are checked at the start of each request.
+"""
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+page_size = mmap.PAGESIZE
+backings = ["numpy", "anonymous", "file"]
+touch_patterns = ["full", "sequential", "random", "sparse"]
+# directory of the files behind file backed allocations
+memory_load_dir = os.getenv("MEMORY_LOAD_DIR", tempfile.gettempdir())
+
+_rng = np.random.default_rng()
+
+
+class Allocation:
+
+    def __init__(self, size=1, backing="numpy"):
+        if backing not in backings:
+            raise ValueError(f"memory_backing should be one of {backings}")
+        self.nbytes = max(int(1024 * 1024 * size), page_size)
+        self.backing = backing
+        self._mmap = None
+        if backing == "numpy":
+            self.array = np.empty(self.nbytes, dtype=np.uint8)
+        else:
+            if backing == "anonymous":
+                self._mmap = mmap.mmap(-1, self.nbytes)
+            else:
+                with tempfile.TemporaryFile(dir=memory_load_dir) as f:
+                    f.truncate(self.nbytes)
+                    self._mmap = mmap.mmap(f.fileno(), self.nbytes)
+            self.array = np.frombuffer(self._mmap, dtype=np.uint8)
+        self.touched_pages = 0
+
+    def touch(self, pattern="full", fraction=0.1):
+        """
+        :return: number of pages touched
+        """
+        if pattern not in touch_patterns:
+            raise ValueError(f"memory_touch should be one of {touch_patterns}")
+        n_pages = (self.nbytes + page_size - 1) // page_size
+        if pattern == "full":
+            self.array.fill(1)
+            pages = n_pages
+        elif pattern == "sequential":
+            self.array[::page_size] = 1
+            pages = n_pages
+        else:
+            if pattern == "random":
+                idx = _rng.permutation(n_pages)
+            else:
+                idx = _rng.choice(n_pages, size=int(np.ceil(n_pages * min(max(fraction, 0.), 1.))), replace=False)
+            # numpy writes the pages in idx order
+            self.array[idx * page_size] = 1
+            pages = len(idx)
+        self.touched_pages = max(self.touched_pages, pages)
+        return pages
+
+    def close(self):
+        self.array = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+def allocate(size=1, touch="full", backing="numpy", fraction=0.1):
+    """
+    :param size: MiB
+    :param fraction: share of the pages the sparse pattern touches
+    :return: Allocation with its pages touched
+    """
+    allocation = Allocation(size, backing)
+    try:
+        allocation.touch(touch, fraction)
+    except ValueError:
+        allocation.close()
+        raise
+    return allocation
+
+
+class RetentionPool:
+    """
+    Allocations held across requests, each until its ttl passes; past budget_bytes the
+    oldest are released first
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self._entries = []  # (expires_at, allocation), in insertion order
+        self._lock = threading.Lock()
+        self.counters = {"retained": 0, "expired": 0, "evicted": 0}
+
+    def hold(self, allocation, ttl):
+        with self._lock:
+            self._entries.append((time.time() + ttl, allocation))
+            self.counters["retained"] += 1
+            self._enforce_budget()
+
+    def _enforce_budget(self):
+        while len(self._entries) > 0 and sum(a.nbytes for _, a in self._entries) > self.budget_bytes:
+            _, allocation = self._entries.pop(0)
+            allocation.close()
+            self.counters["evicted"] += 1
+
+    def expire(self):
+        now = time.time()
+        with self._lock:
+            kept = []
+            for expires_at, allocation in self._entries:
+                if expires_at <= now:
+                    allocation.close()
+                    self.counters["expired"] += 1
+                else:
+                    kept.append((expires_at, allocation))
+            self._entries = kept
+
+    def stats(self):
+        with self._lock:
+            return {
+                "allocations": len(self._entries),
+                "bytes": sum(a.nbytes for _, a in self._entries),
+                "budget_bytes": self.budget_bytes,
+                **self.counters
+            }
+
+
+pool = RetentionPool(budget_bytes=int(float(os.getenv("MEMORY_RETAIN_BUDGET_MB", "256")) * 1024 * 1024))
@@ -1,23 +1,25 @@
 __version__ = '0.2.0'
 
 import datetime
-import json
 import numpy as np
 import psutil
 import os
 import time
 import uuid
-from flask import Flask, Response, request, send_file
+from flask import Flask, request
 from joblib import load
 # server configuration
 from logging.config import dictConfig
 from prometheus_flask_exporter.multiprocess import UWsgiPrometheusMetrics
 
+import load_kernels
+import memory_load
 import model_util as mu
+import serialization
+import workload_profiles
 
 
 HOSTNAME = os.environ.get("HOSTNAME")
-ds = mu.DelayWithStrategy(mu.ConstantStrategy(200))  # const 200 ms sleep
 
 dictConfig({
     'version': 1,
@@ -35,18 +37,15 @@ dictConfig({
 })
 
 app = Flask(__name__)
+# time every load kernel on this host before serving
+app.logger.info(f"load kernel calibration {load_kernels.calibrate_kernels()}")
 
 
 @app.route('/version')
 def configuration():
-    rdata = json.dumps({
+    return serialization.make_response({
         "version": __version__,
         "date": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")})
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
 
 
 @app.route('/', methods=["POST"])
@@ -54,31 +53,79 @@ def main():
     """
     request parameters:
     {
+        "profile": "default",  (optional, a workload profile, see workload_profiles.py)
         "memory_request": 1,
         "memory_request_std": 0,
+        "memory_touch": "full",  (optional, full, sequential, random or sparse)
+        "memory_touch_fraction": 0.1,  (optional, share of the pages sparse touches)
+        "memory_backing": "numpy",  (optional, numpy, anonymous or file)
+        "memory_retain_sec": 0,  (optional, keep the allocation this long after the request)
         "load_request": 1,
-        "load_request_std": 0
+        "load_request_std": 0,
+        "load_request_ms": 25,  (optional, load in ms instead of units, translated through the calibration)
+        "load_request_ms_std": 0,  (optional)
+        "load_kernel": "python"  (optional, python, numpy or hashlib; default LOAD_KERNEL)
     }
+    A unit of load_request takes about LOAD_MS_PER_UNIT ms with every kernel (see load_kernels.py).
+    memory_request is in MiB; see memory_load.py for the touch patterns, backings and retention pool.
+    The profile sets the sleep and, for requests without memory_request or load_request(_ms), samples
+    memory_mb and load_ms; its other fields are defaults for the request fields.
+    Parameters may also be posted as MessagePack, and Accept: application/msgpack
+    returns the response as MessagePack (see serialization.py).
     """
     start_time = time.time()  # seconds
     uid = str(uuid.uuid4())
     app.logger.info(f"request id={uid} at ts={start_time}")
     # get the request parameters and log them
-    parameters = request.get_json()
+    # a document of fields, .npy and Arrow bodies would have none of them
+    parameters = serialization.decode_request(request, formats=[serialization.JSON, serialization.MSGPACK])
     app.logger.info(parameters)
+    if not isinstance(parameters, dict):
+        return serialization.make_response({"errors": ["parameters should be a JSON object"]}, status=400)
+    try:
+        profile = workload_profiles.get_profile(parameters.get("profile"))
+        parameters = dict(profile.defaults, **parameters)
+        kernel = load_kernels.get_kernel(parameters.get("load_kernel"))
+        if "memory_request" in parameters:
+            memory_mb = mu.get_strategy(mu.NormalStrategy, float(parameters["memory_request"]),
+                                        float(parameters.get("memory_request_std", 0))).sample()
+        elif "memory_mb" in profile.strategies:
+            memory_mb = profile.sample("memory_mb")
+        else:
+            raise ValueError(f"give memory_request, profile {profile.name} has no memory_mb")
+        if not any(k in parameters for k in ("load_request", "load_request_ms")) and \
+                "load_ms" not in profile.strategies:
+            raise ValueError(f"give load_request or load_request_ms, profile {profile.name} has no load_ms")
+    except ValueError as e:
+        return serialization.make_response({"errors": [str(e)]}, status=400)
     # allocate memory
     # mem_handle = mu.memory_function(parameters["memory_request"])
-    mem_handle = mu.memory_function(
-        mu.NormalStrategy(parameters["memory_request"],
-                          parameters["memory_request_std"]).sample())
-    app.logger.info(mem_handle.shape)
+    memory_load.pool.expire()
+    try:
+        retain_sec = float(parameters.get("memory_retain_sec", 0))
+        mem_handle = memory_load.allocate(
+            memory_mb,
+            touch=parameters.get("memory_touch", "full"),
+            backing=parameters.get("memory_backing", "numpy"),
+            fraction=float(parameters.get("memory_touch_fraction", 0.1)))
+    except ValueError as e:
+        return serialization.make_response({"errors": [str(e)]}, status=400)
+    app.logger.info(f"{mem_handle.backing} allocation of {mem_handle.nbytes} bytes, "
+                    f"{mem_handle.touched_pages} pages touched")
     # execute loading
     # load_time_ms, n, calibration = mu.load_function(parameters["load_request"])
-    load_time_ms, n, calibration = mu.load_function(
-        mu.NormalStrategy(parameters["load_request"],
-                            parameters["load_request_std"]).sample())
+    if "load_request_ms" in parameters:
+        load_request_ms = mu.get_strategy(mu.NormalStrategy, float(parameters["load_request_ms"]),
+                                          float(parameters.get("load_request_ms_std", 0))).sample()
+        load_units = load_request_ms / kernel.ms_per_unit
+    elif "load_request" in parameters:
+        load_units = mu.get_strategy(mu.NormalStrategy, float(parameters["load_request"]),
+                                     float(parameters.get("load_request_std", 0))).sample()
+    else:
+        load_units = profile.sample("load_ms") / kernel.ms_per_unit
+    load_time_ms, n, calibration = kernel.run(load_units)
     # for fractional loading, sleep part of the time
-    sleep_delay_ms = ds.sleep()
+    sleep_delay_ms = profile.delay.sleep()
     # wrap up measurements
     memory_usage_mb = psutil.Process().memory_info().rss / (1024 * 1024)  # MB
     end_time = time.time()  # seconds
@@ -89,25 +136,61 @@ def main():
         "uuid": uid,
         "start_time_sec": start_time,
         "function_latency_ms": function_latency_ms,
-        "memory_request": parameters["memory_request"],
+        "profile": profile.name,
+        "memory_request": parameters.get("memory_request"),
+        "memory_mb": memory_mb,
         "memory_usage_mb": memory_usage_mb,
         "sleep_delay_ms": sleep_delay_ms,
         "load_time_ms": load_time_ms,
         "load_request": n,
         "load_calibration": calibration,
-        "memory_request_std": parameters["memory_request_std"],
-        "load_request_std": parameters["load_request_std"]
+        "load_kernel": kernel.name,
+        "load_ms_per_unit": kernel.ms_per_unit,
+        "memory_request_std": parameters.get("memory_request_std"),
+        "load_request_std": parameters.get("load_request_std"),
+        "load_request_ms": parameters.get("load_request_ms"),
+        "load_request_ms_std": parameters.get("load_request_ms_std"),
+        "memory_touch": parameters.get("memory_touch", "full"),
+        "memory_backing": mem_handle.backing,
+        "memory_touched_pages": mem_handle.touched_pages,
+        "memory_retain_sec": retain_sec
     }
+    if retain_sec > 0:
+        memory_load.pool.hold(mem_handle, retain_sec)
+    else:
+        mem_handle.close()
     del mem_handle  # let GC know it is okay to drop this ref
-    rdata = json.dumps({
+    response["memory_retained"] = memory_load.pool.stats()
+    res = {
         "version": __version__,
         "date": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M"),
-        "response": response})
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+        "response": response}
+    return serialization.make_response(res, serialization.response_format(request))
+
+
+@app.route('/profiles')
+def profiles():
+    """
+    :return: the workload profiles this worker loaded
+    """
+    return serialization.make_response({
+        "profiles": {name: profile.spec for name, profile in workload_profiles.profiles.items()}})
+
+
+@app.route('/calibration')
+def calibration():
+    """
+    Query parameters: refresh=true times the kernels again and stores the result
+    :return: the calibration of every load kernel in this worker, ms_per_unit is the measured cost of one unit
+    """
+    if request.args.get("refresh", "false").lower() in ("1", "true"):
+        load_kernels.calibrate_kernels(refresh=True)
+    return serialization.make_response({
+        "hostname": HOSTNAME,
+        "calibration_key": load_kernels.calibration_key(),
+        "target_ms_per_unit": load_kernels.target_ms_per_unit,
+        "default_kernel": load_kernels.default_kernel,
+        "kernels": {name: kernel.calibration() for name, kernel in load_kernels.kernels.items()}})
 
 
 if __name__ == "__main__":
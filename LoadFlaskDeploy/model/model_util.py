@@ -1,4 +1,8 @@
-import json
+import abc
+import functools
+import math
+import threading
+
 import numpy as np
 import psutil
 import time
@@ -7,16 +11,17 @@ const_float = 0.346723846287346
 LOAD_CALIBRATION_SCALE = 15000
 
 
-def load_function(n=1):
+def load_function(n=1, scale=LOAD_CALIBRATION_SCALE):
     """
     CPU loading function
+    :param scale: multiplications per unit
     """
     n = int(n)
     start_time = time.time()
     for _ in range(n):
-        for _ in range(LOAD_CALIBRATION_SCALE):
+        for _ in range(scale):
             _ = const_float * const_float
-    return 1000. * (time.time() - start_time), n, LOAD_CALIBRATION_SCALE
+    return 1000. * (time.time() - start_time), n, scale
 
 
 def memory_function(size=1):
@@ -69,59 +74,135 @@ class ConstantStrategy:
         else:
             return np.ones(size) * self.const
 
-class LogNormalStrategy:
+
+class BufferedStrategy(abc.ABC):
+    """
+    Base of the random strategies: each instance draws from its own np.random.Generator
+    (a seed makes it reproducible without touching the global np.random state), and single
+    samples are served from a buffer of buffer_size vectorized draws.
+    """
+    buffer_size = 1024
+
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self._buffer = np.empty(0)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def draw(self, size):
+        """
+        :return: np.array of size samples
+        """
+
+    def sample(self, size=1):
+        if size == 1:
+            with self._lock:
+                if self._next >= len(self._buffer):
+                    self._buffer = self.draw(self.buffer_size)
+                    self._next = 0
+                self._next += 1
+                # This value needs to be json serializable
+                return float(self._buffer[self._next - 1])
+        else:
+            # For generating a pre-deterministic list
+            return self.draw(size)
+
+
+class LogNormalStrategy(BufferedStrategy):
 
     def __init__(self, mu=10, sigma=10, seed=None):
-        np.random.seed(seed)
+        super().__init__(seed)
         mu2 = mu * mu
         sigma2 = sigma * sigma
         self.a = np.log(mu2 / np.sqrt(mu2 + sigma2))
         self.b = np.sqrt(np.log(1. + (sigma2 / mu2)))
 
-    def sample(self, size=1):
+    def draw(self, size):
         """lognormal distributions"""
-        if size == 1:
-            # This value needs to be json serializable
-            return float(np.random.lognormal(self.a, self.b, size=size)[0])
-        else:
-            # For generating a pre-deterministic list
-            return np.random.lognormal(self.a, self.b, size=(size,))
+        return self.rng.lognormal(self.a, self.b, size=size)
 
 
-class NormalStrategy:
+class NormalStrategy(BufferedStrategy):
 
     def __init__(self, mu=10, sigma=2, seed=None):
-        np.random.seed(seed)
+        super().__init__(seed)
         self.mu = mu
         self.sigma = sigma
 
+    def draw(self, size):
+        """truncated normal distributions, return values must be positive"""
+        if self.sigma <= 0:
+            return np.full(size, max(float(self.mu), 0.))
+        res = np.empty(0)
+        while len(res) < size:
+            # oversample by the share of draws expected below zero, then keep the positive ones
+            accept = max(0.5 * (1. + math.erf(self.mu / (self.sigma * math.sqrt(2.)))), 1e-3)
+            n = int((size - len(res)) / accept * 1.1) + 8
+            a = self.rng.normal(self.mu, self.sigma, size=n)
+            res = np.concatenate([res, a[a >= 0]])
+        return res[:size]
+
     def sample(self, size=1):
-        """truncated normal distributions"""
-        res = []
-        for i in range(size):
-            a = -1
-            while a < 0:
-                # return values must be positive
-                a = float(np.random.normal(self.mu, self.sigma, size=size)[0])
-            res.append(a)
-        if size == 1:
-            # This value needs to be json serializable
-            return res[0]
-        else:
-            # For generating a pre-deterministic list
-            return res
+        res = super().sample(size)
+        # For generating a pre-deterministic list
+        return res if size == 1 else res.tolist()
+
+
+class BimodalStrategy(BufferedStrategy):
+
+    def __init__(self, mu=(10, 100), sigma=(2, 20), weight=0.9, seed=None):
+        """
+        Mixture of two truncated normal modes
+        :param weight: share of the samples from the first mode
+        """
+        super().__init__(seed)
+        self.weight = weight
+        self.modes = [NormalStrategy(m, s, seed=self.rng.integers(2 ** 32)) for m, s in zip(mu, sigma)]
 
+    def draw(self, size):
+        n = self.rng.binomial(size, self.weight)
+        res = np.concatenate([self.modes[0].draw(n), self.modes[1].draw(size - n)])
+        self.rng.shuffle(res)
+        return res
 
-class NumpyArrayEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
+
+class EmpiricalStrategy(BufferedStrategy):
+
+    def __init__(self, samples=None, bins=None, counts=None, seed=None):
+        """
+        Replays recorded values, either the samples themselves or a histogram of them
+        :param bins: histogram bin edges, one more than counts
+        """
+        super().__init__(seed)
+        if samples is not None:
+            self.samples = np.asarray(samples, dtype=np.float64)
+            if len(self.samples) == 0:
+                raise ValueError("empirical strategy needs at least one sample")
         else:
-            return super(NumpyArrayEncoder, self).default(obj)
+            self.samples = None
+            self.bins = np.asarray(bins, dtype=np.float64)
+            counts = np.asarray(counts, dtype=np.float64)
+            if len(self.bins) != len(counts) + 1 or counts.sum() <= 0:
+                raise ValueError("empirical strategy needs len(bins) == len(counts) + 1 and some counts")
+            self.p = counts / counts.sum()
+
+    def draw(self, size):
+        if self.samples is not None:
+            return self.rng.choice(self.samples, size=size)
+        idx = self.rng.choice(len(self.p), size=size, p=self.p)
+        return self.rng.uniform(self.bins[idx], self.bins[idx + 1])
+
+
+@functools.lru_cache(maxsize=256)
+def get_strategy(strategy_type, *args):
+    """
+    Strategies shared by all requests with the same parameters, so requests neither
+    build strategies nor reseed anything
+    :param strategy_type: e.g. NormalStrategy
+    :param args: its parameters, e.g. mu, sigma
+    """
+    return strategy_type(*args)
 
 
 if __name__ == "__main__":
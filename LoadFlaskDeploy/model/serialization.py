@@ -0,0 +1,219 @@
+"""
+Request/response body formats for the model endpoints.
+
+JSON is the default, encoded with orjson when it is installed (numpy arrays are then
+serialized natively instead of through NumpyArrayEncoder). Clients may send and ask
+for (Content-Type / Accept):
+  application/x-npy                    a single .npy array, other fields go in the query string
+                                       (request) or the X-Metadata JSON header (response)
+  application/vnd.apache.arrow.stream  Arrow IPC stream of a table, needs pyarrow
+  application/msgpack                  the JSON document as MessagePack, needs msgpack;
+                                       numeric arrays travel as raw buffers
+Endpoints that only take a document of fields pass formats=[JSON, MSGPACK] to
+decode_request, so other bodies get a 415 instead of a document without its fields.
+
+Every service builds its image from its own directory, so each has a copy of this
+module; keep the three copies identical.
+"""
+import datetime
+import io
+import json
+
+import numpy as np
+import pandas as pd
+from flask import Response
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+JSON = "application/json"
+NPY = "application/x-npy"
+ARROW = "application/vnd.apache.arrow.stream"
+MSGPACK = "application/msgpack"
+
+
+class NumpyArrayEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, pd.Timestamp):
+            return str(obj)
+        elif isinstance(obj, pd.Index):
+            return list(obj)
+        elif isinstance(obj, np.integer):
+            return int(obj)
+        elif isinstance(obj, np.floating):
+            return float(obj)
+        elif isinstance(obj, np.ndarray):
+            return obj.tolist()
+        else:
+            return super(NumpyArrayEncoder, self).default(obj)
+
+
+def _orjson_default(obj):
+    if isinstance(obj, (pd.Timestamp, datetime.datetime, datetime.date)):
+        return str(obj)
+    elif isinstance(obj, pd.Index):
+        return obj.tolist()
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()  # only arrays orjson cannot take natively (object, strings)
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError
+
+
+_orjson_options = 0 if orjson is None else \
+    orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
+def frame_rows(df):
+    """
+    Rows of a DataFrame for a JSON body, with datetime columns formatted once per
+    column (like str(pd.Timestamp)) rather than once per cell
+    """
+    df = df.copy(deep=False)
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime("%Y-%m-%d %H:%M:%S")
+    return df.to_numpy()
+
+
+def dumps(obj):
+    """
+    :return: JSON document as bytes (orjson) or str (json module fallback)
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_orjson_default, option=_orjson_options)
+    return json.dumps(obj, cls=NumpyArrayEncoder)
+
+
+def available_formats():
+    formats = [JSON, NPY]  # JSON first: it is what */* gets
+    if pa is not None:
+        formats.append(ARROW)
+    if msgpack is not None:
+        formats.append(MSGPACK)
+    return formats
+
+
+def request_format(req, formats=None):
+    """
+    :param formats: the Content-Types the endpoint accepts, default every available format
+    """
+    accepted = [f for f in available_formats() if formats is None or f in formats]
+    fmt = req.mimetype or JSON
+    if fmt not in accepted:
+        raise UnsupportedMediaType(f"Content-Type {fmt} not supported (use one of {accepted})")
+    return fmt
+
+
+def response_format(req):
+    return req.accept_mimetypes.best_match(available_formats(), default=JSON)
+
+
+def _pack_ndarray(obj):
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind in "biuf":
+            return {"__ndarray__": True, "dtype": obj.dtype.str, "shape": list(obj.shape),
+                    "data": np.ascontiguousarray(obj).tobytes()}
+        return obj.tolist()
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        return _pack_ndarray(obj.to_numpy())
+    elif isinstance(obj, (pd.Timestamp, pd.Index)):
+        return NumpyArrayEncoder().default(obj)
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not msgpack serializable")
+
+
+def _unpack_ndarray(obj):
+    if obj.get("__ndarray__"):
+        # a read-only view on the request buffer, no copy
+        return np.frombuffer(obj["data"], dtype=np.dtype(obj["dtype"])).reshape(obj["shape"])
+    return obj
+
+
+def decode_request(req, formats=None):
+    """
+    :param formats: the Content-Types the endpoint accepts, default every available format
+    :return: the request document as a dict; "data" is an np.array for .npy bodies and
+        a pd.DataFrame for Arrow bodies, other fields come from the query string
+    """
+    fmt = request_format(req, formats)
+    try:
+        if fmt == JSON:
+            return req.get_json()
+        elif fmt == MSGPACK:
+            return msgpack.unpackb(req.get_data(), object_hook=_unpack_ndarray)
+        records = dict(req.args)
+        if fmt == NPY:
+            records["data"] = np.load(io.BytesIO(req.get_data()), allow_pickle=False)
+        else:
+            records["data"] = pa.ipc.open_stream(req.get_data()).read_all().to_pandas()
+        return records
+    except (ValueError, TypeError, OSError) as e:
+        raise BadRequest(f"could not decode {fmt} body: {e}")
+
+
+def _to_table(data, header=None):
+    if isinstance(data, pd.DataFrame):
+        return pa.Table.from_pandas(data, preserve_index=False)
+    data = np.asarray(data)
+    if data.ndim == 1:
+        return pa.table({"data": data})
+    if header is None:
+        header = [f"c{i}" for i in range(data.shape[1])]
+    return pa.table({str(name): data[:, i] for i, name in enumerate(header)})
+
+
+def encode_body(payload, fmt=JSON):
+    """
+    :param payload: response document; for .npy and Arrow only payload["data"] goes in the body
+    :return: body bytes, content type, extra headers
+    """
+    if fmt in (NPY, ARROW) and "data" not in payload:
+        fmt = JSON  # nothing tabular to send (e.g. an error report)
+    if fmt == MSGPACK:
+        return msgpack.packb(payload, default=_pack_ndarray), MSGPACK, []
+    elif fmt == NPY or fmt == ARROW:
+        data = payload["data"]
+        metadata = {k: v for k, v in payload.items() if k != "data"}
+        headers = [('X-Metadata', json.dumps(metadata, cls=NumpyArrayEncoder))]
+        buf = io.BytesIO()
+        if fmt == NPY:
+            if isinstance(data, pd.DataFrame):
+                data = data.to_records(index=False)
+            np.save(buf, np.asarray(data), allow_pickle=False)
+        else:
+            table = _to_table(data, payload.get("header"))
+            with pa.ipc.new_stream(buf, table.schema) as writer:
+                writer.write_table(table)
+        return buf.getvalue(), fmt, headers
+    if isinstance(payload.get("data"), pd.DataFrame):
+        payload = dict(payload, data=frame_rows(payload["data"]))
+    return dumps(payload), JSON, []
+
+
+def body_response(rdata, content_type=JSON, headers=(), status=200):
+    """
+    :return: Response for an already encoded body (see encode_body)
+    """
+    response_headers = [
+        ('Content-type', content_type),
+        ('Content-Length', str(len(rdata)))
+    ] + list(headers)
+    return Response(response=rdata, status=status, headers=response_headers)
+
+
+def make_response(payload, fmt=JSON, status=200):
+    rdata, content_type, headers = encode_body(payload, fmt)
+    return body_response(rdata, content_type, headers, status)
@@ -0,0 +1,114 @@
+"""
+Named workload profiles: the distributions of sleep, CPU load and memory of a request.
+
+Profiles come from the JSON or YAML (needs pyyaml) file LOAD_PROFILES_FILE, or from the
+env var LOAD_PROFILES holding the document itself, e.g.
+
+  {"tail": {
+      "sleep_ms": {"strategy": "bimodal", "mu": [20, 400], "sigma": [5, 100], "weight": 0.95},
+      "load_ms": {"strategy": "empirical", "samples_file": "latencies.txt"},
+      "memory_mb": {"strategy": "lognormal", "mu": 4, "sigma": 2},
+      "load_kernel": "hashlib"}}
+
+Strategies (see model_util.py):
+  constant   value
+  normal     mu, sigma (truncated at 0)
+  lognormal  mu, sigma (mean and standard deviation of the samples)
+  empirical  samples, samples_file (one value per line) or a histogram of bins and counts
+  bimodal    mu, sigma (two of each), weight of the first mode
+Every strategy also takes an optional seed. Other profile fields (load_kernel, memory_touch,
+memory_backing, ...) are defaults for the request fields of the same name. The "default"
+profile applies to requests without a profile.
+"""
+import json
+import os
+
+import model_util as mu
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+profiles_file = os.getenv("LOAD_PROFILES_FILE")
+strategy_fields = ["sleep_ms", "load_ms", "memory_mb"]
+# the service's behaviour before profiles: a constant 200 ms sleep
+default_profile = {"sleep_ms": {"strategy": "constant", "value": 200}}
+
+
+def _parse(text, yaml_document=False):
+    if yaml_document or (yaml is not None and not text.lstrip().startswith("{")):
+        if yaml is None:
+            raise ValueError("YAML profiles need pyyaml, use JSON instead")
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def build_strategy(spec, base_path="."):
+    """
+    :param spec: {"strategy": "normal", "mu": 10, "sigma": 2, ...} or a number for a constant
+    :return: strategy with a sample() method
+    """
+    if isinstance(spec, (int, float)):
+        return mu.ConstantStrategy(spec)
+    spec = dict(spec)
+    kind = spec.pop("strategy", "constant")
+    seed = spec.pop("seed", None)
+    if kind == "constant":
+        return mu.ConstantStrategy(spec["value"])
+    elif kind == "normal":
+        return mu.NormalStrategy(spec["mu"], spec["sigma"], seed)
+    elif kind == "lognormal":
+        return mu.LogNormalStrategy(spec["mu"], spec["sigma"], seed)
+    elif kind == "bimodal":
+        return mu.BimodalStrategy(spec["mu"], spec["sigma"], spec.get("weight", 0.5), seed)
+    elif kind == "empirical":
+        samples = spec.get("samples")
+        if "samples_file" in spec:
+            with open(os.path.join(base_path, spec["samples_file"]), "r") as infile:
+                samples = [float(line) for line in infile if line.strip()]
+        return mu.EmpiricalStrategy(samples, spec.get("bins"), spec.get("counts"), seed)
+    raise ValueError(f"unknown strategy {kind}, use constant, normal, lognormal, empirical or bimodal")
+
+
+class Profile:
+
+    def __init__(self, name, spec, base_path="."):
+        self.name = name
+        self.spec = spec
+        self.strategies = {field: build_strategy(spec[field], base_path)
+                           for field in strategy_fields if field in spec}
+        self.defaults = {k: v for k, v in spec.items() if k not in strategy_fields}
+        self.delay = mu.DelayWithStrategy(self.strategies.get("sleep_ms", mu.ConstantStrategy(0)))
+
+    def sample(self, field):
+        """
+        :return: a sample of sleep_ms, load_ms or memory_mb, None if the profile does not set it
+        """
+        strategy = self.strategies.get(field)
+        return None if strategy is None else max(float(strategy.sample()), 0.)
+
+
+def load_profiles():
+    """
+    :return: {name: Profile}, always with a default profile
+    """
+    specs, base_path = {}, "."
+    if profiles_file is not None:
+        with open(profiles_file, "r") as infile:
+            specs = _parse(infile.read(), profiles_file.endswith((".yaml", ".yml")))
+        base_path = os.path.dirname(os.path.abspath(profiles_file))
+    elif os.getenv("LOAD_PROFILES"):
+        specs = _parse(os.getenv("LOAD_PROFILES"))
+    specs = dict({"default": default_profile}, **(specs or {}))
+    return {name: Profile(name, spec, base_path) for name, spec in specs.items()}
+
+
+profiles = load_profiles()
+
+
+def get_profile(name=None):
+    name = name or "default"
+    if name not in profiles:
+        raise ValueError(f"profile should be one of {list(profiles)}")
+    return profiles[name]
@@ -0,0 +1,126 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+
+enabled = os.getenv("MICRO_BATCH", "false").lower() in ("1", "true", "yes")
+window_ms = float(os.getenv("MICRO_BATCH_WINDOW_MS", "2"))
+max_rows = int(os.getenv("MICRO_BATCH_MAX_ROWS", "64"))
+# a row not answered within this many ms is predicted directly by the request thread
+timeout_ms = float(os.getenv("MICRO_BATCH_TIMEOUT_MS", "1000"))
+
+
+class MicroBatcher:
+    """
+    Coalesce single-row predictions from concurrent request threads into one call.
+
+    The first row that arrives opens a batch; the batch is closed after window_ms or
+    when it holds max_rows rows, whichever is first. predict_fn gets the stacked rows
+    as one 2 dim np.array and must return one result per row.
+    A row that waits longer than timeout_ms is predicted on its own, so a stuck or
+    dead worker thread slows requests down instead of blocking them.
+    """
+
+    def __init__(self, predict_fn, window_ms=window_ms, max_rows=max_rows):
+        self.predict_fn = predict_fn
+        self.window = window_ms / 1000.
+        self.max_rows = max_rows
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None  # the worker thread does not survive uWSGI's fork, start it per process
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.metrics = {
+            "batches": 0,
+            "rows": 0,
+            "max_batch_size": 0,
+            "batch_size_histogram": {},
+            "queue_wait_ms_total": 0.,
+            "queue_wait_ms_max": 0.,
+            "predict_ms_total": 0.,
+            "errors": 0,
+            "timeouts": 0
+        }
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, daemon=True, name="micro-batcher").start()
+                    self._pid = os.getpid()
+
+    def submit(self, row):
+        """
+        :param row: one feature vector
+        :return: Future resolving to the prediction for this row
+        """
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((row, future, time.perf_counter()))
+        return future
+
+    def predict(self, row, timeout=timeout_ms / 1000.):
+        try:
+            return self.submit(row).result(timeout=timeout)
+        except TimeoutError:
+            self.metrics["timeouts"] += 1
+            return self.predict_fn(np.asarray(row)[np.newaxis])[0]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_rows:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                start = time.perf_counter()
+                rows = np.stack([np.asarray(row) for row, _, _ in batch])
+                results = self.predict_fn(rows)
+                done = time.perf_counter()
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+                self._record(batch, start, done)
+            except Exception as e:  # e.g. rows of different shapes, the thread must keep running
+                self.metrics["errors"] += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _record(self, batch, start, done):
+        m = self.metrics
+        size = len(batch)
+        waits = [1000. * (start - enqueued) for _, _, enqueued in batch]
+        m["batches"] += 1
+        m["rows"] += size
+        m["max_batch_size"] = max(m["max_batch_size"], size)
+        m["batch_size_histogram"][size] = m["batch_size_histogram"].get(size, 0) + 1
+        m["queue_wait_ms_total"] += sum(waits)
+        m["queue_wait_ms_max"] = max(m["queue_wait_ms_max"], max(waits))
+        m["predict_ms_total"] += 1000. * (done - start)
+
+    def describe(self):
+        m = dict(self.metrics)
+        m["batch_size_histogram"] = dict(m["batch_size_histogram"])
+        m["mean_batch_size"] = m["rows"] / m["batches"] if m["batches"] else 0.
+        m["mean_queue_wait_ms"] = m["queue_wait_ms_total"] / m["rows"] if m["rows"] else 0.
+        return {
+            "pid": os.getpid(),
+            "window_ms": 1000. * self.window,
+            "max_rows": self.max_rows,
+            "metrics": m
+        }
@@ -0,0 +1,155 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from joblib import load
+
+model_path = "../data/"
+model_files = {
+    "decision_tree": model_path + "decision_tree.pkl",
+    "neural_net": model_path + "neural_net.pkl",
+    "neural_net_scaler": model_path + "neural_net_scaler.pkl"
+}
+# models that can serve /predict (the scaler is a companion of the neural net)
+servable_models = ["decision_tree", "neural_net"]
+# files loaded together with a servable model
+companions = {"neural_net": ["neural_net_scaler"]}
+default_model = os.getenv("ACTIVE_MODEL", "decision_tree")
+# name of the active model, shared by all workers so a switch reaches each of them
+active_model_file = model_path + "active_model"
+# seconds between file mtime checks on the request path
+reload_check_interval = float(os.getenv("MODEL_RELOAD_CHECK_SEC", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class ModelLoadError(RuntimeError):
+    pass
+
+
+def label_lookup(model):
+    """
+    Precompute the 0/1 encoding of a classifier's classes (">50K" is 1)
+    :return: np.array aligned with model.classes_, or None if the model has no classes_
+    """
+    classes = getattr(model, "classes_", None)
+    if classes is None:
+        return None
+    return np.array([1 if ">" in str(c) else 0 for c in classes])
+
+
+class ModelRegistry:
+    """
+    Holds the unpickled models for this process.
+
+    Loading happens once (at import of model_serve, i.e. in the uWSGI master, so
+    forked workers share the pages copy-on-write). Only the active model and its
+    companions are loaded; the neural net needs keras, which the deployed image may
+    not have. Reloads build a complete new snapshot and swap it in with a single
+    assignment, so a request that already holds a snapshot finishes with the models
+    it started with. Switching the active model is recorded in active_file, which
+    every worker checks together with the model file mtimes.
+    """
+
+    def __init__(self, files=None, active=default_model, check_interval=reload_check_interval,
+                 active_file=active_model_file):
+        self.files = dict(model_files if files is None else files)
+        self.check_interval = check_interval
+        self.active_file = active_file
+        self._lock = threading.Lock()
+        self._last_check = 0.
+        self._snapshot = self._load_snapshot(active)
+        self._write_active(active)
+
+    def _load_snapshot(self, active):
+        if active not in servable_models:
+            raise ValueError(f"unknown model {active} (should be one of {servable_models})")
+        models, mtimes = {}, {}
+        for name in [active] + companions.get(active, []):
+            fn = self.files[name]
+            if not os.path.exists(fn):
+                raise FileNotFoundError(f"model file for {name} not found ({fn})")
+            mtimes[name] = os.path.getmtime(fn)
+            try:
+                models[name] = load(fn)
+            except Exception as e:  # e.g. keras missing, a truncated or corrupt pickle
+                raise ModelLoadError(f"could not load {name} from {fn}: {e!r}") from e
+        return {
+            "active": active,
+            "models": models,
+            "label_lookups": {name: label_lookup(model) for name, model in models.items()},
+            "mtimes": mtimes,
+            "loaded_at": time.time()
+        }
+
+    def _files_changed(self, snapshot):
+        for name, mtime in snapshot["mtimes"].items():
+            fn = self.files[name]
+            if os.path.exists(fn) and os.path.getmtime(fn) != mtime:
+                return True
+        return False
+
+    def _read_active(self):
+        try:
+            with open(self.active_file) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def _write_active(self, active):
+        tmp_file = f"{self.active_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                f.write(active)
+            os.replace(tmp_file, self.active_file)
+        except OSError as e:
+            # the switch still applies to this worker
+            logger.error(f"could not record the active model in {self.active_file}: {e}")
+
+    def reload(self, active=None):
+        """
+        Load the active model's files and swap them in. Optionally change the active model,
+        which the other workers pick up at their next check.
+        The current snapshot stays in place if loading fails.
+        :return: description of the new snapshot
+        """
+        with self._lock:
+            switch = active is not None
+            if active is None:
+                active = self._snapshot["active"]
+            self._snapshot = self._load_snapshot(active)
+            self._last_check = time.time()
+            if switch:
+                self._write_active(active)
+        return self.describe()
+
+    def snapshot(self):
+        """
+        :return: the current snapshot, reloading first if another worker switched the
+            active model or a model file changed on disk
+        """
+        now = time.time()
+        if now - self._last_check > self.check_interval:
+            self._last_check = now
+            active = self._read_active()
+            if active == self._snapshot["active"]:
+                active = None
+            if active is not None or self._files_changed(self._snapshot):
+                try:
+                    self.reload(active)
+                except (ValueError, OSError, ModelLoadError) as e:
+                    # e.g. a pickle caught mid-write, try again at the next check
+                    logger.error(f"model reload failed, serving the previous snapshot: {e}")
+        return self._snapshot
+
+    def describe(self):
+        snapshot = self._snapshot
+        return {
+            "pid": os.getpid(),
+            "active": snapshot["active"],
+            "loaded": sorted(snapshot["models"].keys()),
+            "mtimes": snapshot["mtimes"],
+            "loaded_at": snapshot["loaded_at"]
+        }
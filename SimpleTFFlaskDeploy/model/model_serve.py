@@ -1,15 +1,16 @@
 __version__ = '0.1.0'
 
-from flask import Flask, Response, request, send_file
-import json
+from flask import Flask, request
 import datetime
+import warnings
 
 import numpy as np
 import pandas as pd
 
-from joblib import load
-
+import batching
+import serialization
 import training_data
+from model_registry import ModelLoadError, ModelRegistry
 #import tensorflow as tf
 
 # server configuration
@@ -31,30 +32,73 @@ dictConfig({
 })
 
 app = Flask(__name__)
-
-
-class NumpyArrayEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        else:
-            return super(NumpyArrayEncoder, self).default(obj)
+# load models once, before uWSGI forks the workers
+registry = ModelRegistry()
+try:
+    training_data.encoded_feature_array()  # example rows for /example, shared the same way
+except OSError as e:
+    app.logger.warning(f"example data not preloaded: {e}")
 
 
 @app.route('/version')
 def configuration():
-    rdata = json.dumps({
+    return serialization.make_response({
         "version": __version__,
         "date": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")})
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+
+
+# the models were fit on DataFrames; plain arrays in the same column order are fine
+warnings.filterwarnings("ignore", message="X does not have valid feature names")
+
+
+def _needs_frame(e):
+    # what sklearn raises for estimators that select or check columns by name
+    msg = str(e).lower()
+    return isinstance(e, ValueError) and ("feature names" in msg or "dataframe" in msg)
+
+
+def _estimator_predict(snapshot, name, method, data):
+    """
+    Call the estimator on the float64 array; estimators that insist on column
+    names get a DataFrame instead, and keep getting one for this snapshot.
+    """
+    fn = getattr(snapshot["models"][name], method)
+    frame_only = snapshot.setdefault("frame_only", set())
+    if name not in frame_only:
+        try:
+            return fn(data)
+        except ValueError as e:
+            if not _needs_frame(e):
+                raise
+            app.logger.warning(f"{name}.{method} needs a DataFrame, using the pandas path: {e}")
+            frame_only.add(name)
+    return fn(pd.DataFrame(data, columns=training_data.features))
+
+
+def predict_rows(data):
+    """
+    :param data: 2 dim float64 array of feature vectors in training_data.features order
+    :return: np.array of 0/1 predictions, name of the model that made them
+    """
+    snapshot = registry.snapshot()  # hold on to one consistent set of models
+    if snapshot["active"] == "neural_net":
+        data = _estimator_predict(snapshot, "neural_net_scaler", "transform", data)
+        y_pred = np.argmin(snapshot["models"]["neural_net"].predict(data), axis=1)
+    else:
+        y_pred = _estimator_predict(snapshot, "decision_tree", "predict", data)
+        lookup = snapshot["label_lookups"]["decision_tree"]
+        classes = snapshot["models"]["decision_tree"].classes_
+        y_pred = lookup[np.searchsorted(classes, y_pred)]
+    return y_pred, snapshot["active"]
+
+
+def _predict_batch(rows):
+    y_pred, active = predict_rows(rows)
+    return [(y, active) for y in y_pred]
+
+
+# coalesce concurrent single-row predictions (MICRO_BATCH=true, needs uWSGI threads)
+batcher = batching.MicroBatcher(_predict_batch) if batching.enabled else None
 
 
 @app.route('/predict', methods=['POST'])
@@ -67,48 +111,81 @@ def predict():
             ['age', 'fnlwgt', 'sex-val', 'education-num', "capital-gain", "capital-loss", "hours-per-week"]
         ]
     }
+    The rows may also be posted as a .npy array, an Arrow stream or MessagePack, and the
+    response format follows the Accept header (see serialization.py).
     :return:
     """
-    records = request.get_json()
-    res = training_data.vet_features(records["data"])
+    records = serialization.decode_request(request)
+    try:
+        data = training_data.to_feature_array(records["data"])
+        res = training_data.vet_features(data)
+    except ValueError:
+        res = training_data.vet_features(records["data"])  # report what is wrong with the payload
     if len(res["errors"]) > 0:
-        rdata = json.dumps(res, cls=NumpyArrayEncoder)
+        return serialization.make_response(res)
+    if batcher is not None and len(data) == 1:
+        y, active = batcher.predict(data[0])
+        y_pred = np.array([y])
+    else:
+        y_pred, active = predict_rows(data)
+    res = {
+        "size": len(y_pred),
+        "data": y_pred,
+        "model": active}
+    return serialization.make_response(res, serialization.response_format(request))
+
+
+@app.route('/batching')
+def batching_metrics():
+    """
+    Micro-batching configuration and batch size / queue wait metrics of this worker
+    """
+    if batcher is None:
+        res = {"enabled": False}
     else:
-        df = pd.DataFrame(records["data"], columns=training_data.features)
-        model = load("../data/decision_tree.pkl")
-        y_pred = model.predict(df)
-        rdata = json.dumps({
-            "size": len(y_pred),
-            "data": [1 if ">" in x else 0 for x in y_pred]},
-            cls=NumpyArrayEncoder)
-        # model_nn_sc = load("../data/neural_net_scaler.pkl")
-        # model = load("../data/neural_net.pkl")
-        # data = model_nn_sc.transform(df)
-        # y_pred = model.predict(data)
-        # rdata = json.dumps({"size": len(y_pred), "data": [np.argmin(x) for x in y_pred]}, cls=NumpyArrayEncoder)
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+        res = {"enabled": True, **batcher.describe()}
+    return serialization.make_response(res)
+
+
+@app.route('/model')
+def model_info():
+    return serialization.make_response(registry.describe())
+
+
+@app.route('/model/reload', methods=['POST'])
+def model_reload():
+    """
+    Reload the model files in this worker without dropping in-flight requests.
+    Switching the active model reaches the other workers at their next file check.
+    Optional JSON Post Payload:
+    { "active": "decision_tree" }
+    :return: description of the loaded models
+    """
+    records = request.get_json(silent=True) or {}
+    try:
+        return serialization.make_response(registry.reload(records.get("active")))
+    except (ValueError, FileNotFoundError) as e:
+        return serialization.make_response({"errors": [str(e)]}, status=400)
+    except ModelLoadError as e:
+        app.logger.error(str(e))
+        return serialization.make_response({"errors": [str(e)]}, status=500)
 
 
 @app.route('/example')
 @app.route('/examples/<n>')
 def examples(n=1):
+    """
+    Optional query parameter seed=<int> makes the sample reproducible.
+    """
     n = int(n)
     assert (n > 0)
-    data = training_data.random_feature_sample_array(n)
+    seed = request.args.get("seed", None, type=int)
+    data = training_data.random_feature_sample_array(n, seed=seed)
     res = {
         "size": n,
         "data": data
     }
-    rdata = json.dumps(res, cls=NumpyArrayEncoder)
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+    return serialization.make_response(res)
 
 @app.route('/vetter', methods=["POST"])
 def vetter():
@@ -120,17 +197,15 @@ def vetter():
             ['age', 'fnlwgt', 'sex-val', 'education-num', "capital-gain", "capital-loss", "hours-per-week"]
         ]
     }
+    Query parameter compact=true returns per-feature violation counts and row indexes
+    instead of one message per violation.
     :return:
     """
     records = request.get_json()
     app.logger.debug(records)
-    res = training_data.vet_features(records["data"])
-    rdata = json.dumps(res, cls=NumpyArrayEncoder)
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+    compact = request.args.get("compact", "false").lower() in ("1", "true", "yes")
+    res = training_data.vet_features(records["data"], compact=compact)
+    return serialization.make_response(res)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
@@ -1,4 +1,5 @@
 import csv
+import os
 
 import pandas as pd
 import numpy as np
@@ -6,6 +7,8 @@ import numpy as np
 file_path = "../data/"
 hfile = file_path + "adult.names"
 dfile = file_path + "adult.data"
+# encoded feature matrix, memory-mapped by every worker once written
+encoded_features_file = os.getenv("ENCODED_FEATURES_FILE", file_path + "encoded_features.npy")
 features = ['age', 'fnlwgt', 'sex-val', 'education-num', "capital-gain", "capital-loss", "hours-per-week"]
 with open(file_path + "feature_vetting.csv", "r") as infile:
     rdr = csv.reader(infile)
@@ -17,6 +20,12 @@ with open(file_path + "feature_vetting.csv", "r") as infile:
             vheader = False
         else:
             vetting.append([line[0]] + [float(x) for x in line[1:]])
+# bound arrays in model feature order for vectorized vetting
+_vet_by_feature = {row[0]: row for row in vetting}
+vet_min = np.array([_vet_by_feature[f][vkeys["min"]] for f in features])
+vet_max = np.array([_vet_by_feature[f][vkeys["max"]] for f in features])
+vet_q1 = np.array([_vet_by_feature[f][vkeys["25%"]] for f in features])
+vet_q3 = np.array([_vet_by_feature[f][vkeys["75%"]] for f in features])
 
 
 def get_header():
@@ -43,41 +52,115 @@ def select_encoded_features():
     return df[features].copy()
 
 
-def random_feature_sample(n=1):
-    df = select_encoded_features()
-    return df.sample(n)
+_encoded_feature_array = None
+_rng = np.random.default_rng()
 
 
-def random_feature_sample_array(n=1):
-    df = random_feature_sample(n)
-    return df.to_numpy(copy=True)
+def encoded_feature_array():
+    """
+    Encoded training features as one contiguous array, built once per process.
+    The array is persisted to encoded_features_file and memory-mapped so workers share the pages.
+    :return: 2 dim np.array with columns in features order
+    """
+    global _encoded_feature_array
+    if _encoded_feature_array is None:
+        if os.path.exists(encoded_features_file) and (not os.path.exists(dfile) or
+                os.path.getmtime(encoded_features_file) >= os.path.getmtime(dfile)):
+            _encoded_feature_array = np.load(encoded_features_file, mmap_mode="r")
+        else:
+            df = get_training_dataframe()
+            df["sex-val"] = df["sex"].str.contains("M").astype(np.int64)
+            arr = np.ascontiguousarray(df[features].to_numpy())
+            try:
+                np.save(encoded_features_file, arr)
+                arr = np.load(encoded_features_file, mmap_mode="r")
+            except OSError:
+                pass  # read only data directory, keep the private copy
+            _encoded_feature_array = arr
+    return _encoded_feature_array
+
+
+def random_feature_sample_array(n=1, seed=None):
+    """
+    :param n: number of rows to sample (without replacement)
+    :param seed: optional seed for this sample only
+    :return: 2 dim np.array of encoded feature rows
+    """
+    arr = encoded_feature_array()
+    rng = _rng if seed is None else np.random.default_rng(seed)
+    idx = rng.choice(arr.shape[0], size=n, replace=False)
+    return arr[idx]
+
+
+def random_feature_sample(n=1, seed=None):
+    return pd.DataFrame(random_feature_sample_array(n, seed), columns=features)
+
 
+def to_feature_array(data):
+    """
+    Copy request rows straight into a preallocated float64 array (no DataFrame)
+    :param data: list of rows (or 2 dim array), row length must be equal to features in the model
+    :return: 2 dim np.array of float64
+    :raises ValueError: rows with the wrong length or non-numeric values
+    """
+    if np.ndim(data) != 2:
+        # a flat row would broadcast into every row of the array
+        raise ValueError(f"data should be a list of rows, got {np.ndim(data)} dimensions")
+    if isinstance(data, np.ndarray) and data.dtype == np.float64:
+        arr = data
+    else:
+        arr = np.empty((len(data), len(features)), dtype=np.float64)
+        arr[...] = data
+    if arr.shape[1] != len(features):
+        raise ValueError(f"Wrong number of features (got {arr.shape[1]} but should be {len(features)})")
+    return arr
+
+
+def _violation_messages(data, mask, lower, upper, kind):
+    msgs = []
+    # feature major, then vector order, as the messages were always reported
+    for fidx, didx in zip(*np.nonzero(mask.T)):
+        msgs.append(f"feature {features[fidx]} value ({data[didx, fidx]}) out of {kind} "
+                    f"[{lower[fidx]}, {upper[fidx]}] "
+                    f"of training data in vector {didx}")
+    return msgs
 
-def vet_features(data):
+
+def _violation_summary(mask):
+    counts = mask.sum(axis=0)
+    return {features[fidx]: {"count": int(counts[fidx]), "rows": np.nonzero(mask[:, fidx])[0]}
+            for fidx in np.nonzero(counts)[0]}
+
+
+def vet_features(data, compact=False):
     """
     :param data: 2 dim np.array, row length must be equal to features in the model
+    :param compact: report per-feature violation counts and row indexes instead of messages
     :return: dictionary of analysis results include size, list of errors and list of warnings
     """
-    if isinstance(data, list):
-        data = np.array(data)
-    msgs = {"size": data.shape, "errors": [], "warnings": []}
-    if len(data[0]) != len(features):
-        msgs["errors"].append(f"Wrong number of features (got {len(data[0])} but should be {len(features)})")
+    try:
+        data = np.asarray(data)
+    except ValueError:
+        return {"size": [len(data)], "errors": ["Feature vectors have different lengths"], "warnings": []}
+    msgs = {"size": data.shape, "errors": {} if compact else [], "warnings": {} if compact else []}
+    if data.ndim != 2:
+        msgs["errors"] = [f"data should be a list of rows (got {data.ndim} dimensions)"]
+        return msgs
+    if data.shape[1] != len(features):
+        msgs["errors"] = [f"Wrong number of features (got {data.shape[1]} but should be {len(features)})"]
+        return msgs
+    try:
+        data = data.astype(np.float64, copy=False)
+    except ValueError as e:
+        msgs["errors"] = [f"Non-numeric feature value ({e})"]
         return msgs
-    for vidx, vet_row in enumerate(vetting):
-        if vidx == 0:
-            continue
-        # in order we should receive features
-        for didx, data_row in enumerate(data):
-            d = float(data_row[vidx])
-            if d < vet_row[vkeys["min"]] or d > vet_row[vkeys["max"]]:
-                _msg = (f"feature {vetting[vidx][0]} value ({d}) out of range "
-                        f"[{vet_row[vkeys['min']]}, {vet_row[vkeys['max']]}] "
-                        f"of training data in vector {didx}")
-                mesg["errors"].append(_msg)
-            if d < vet_row[vkeys["25%"]] or d > vet_row[vkeys["75%"]]:
-                _msg = (f"feature {vetting[vidx][0]} value ({d}) out of quartile range "
-                        f"[{vet_row[vkeys['25%']]}, {vet_row[vkeys['75%']]}] "
-                        f"of training data in vector {didx}")
-                msgs["warnings"].append(_msg)
+    # null cells arrive as NaN, which no bound comparison catches
+    out_of_range = ~np.isfinite(data) | (data < vet_min) | (data > vet_max)
+    out_of_quartiles = (data < vet_q1) | (data > vet_q3)
+    if compact:
+        msgs["errors"] = _violation_summary(out_of_range)
+        msgs["warnings"] = _violation_summary(out_of_quartiles)
+    else:
+        msgs["errors"] = _violation_messages(data, out_of_range, vet_min, vet_max, "range")
+        msgs["warnings"] = _violation_messages(data, out_of_quartiles, vet_q1, vet_q3, "quartile range")
     return msgs
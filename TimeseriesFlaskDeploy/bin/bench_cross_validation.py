@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Wall time of Prophet cross validation, serial versus cutoffs fanned out over
+processes and threads (model/model_validation.py), on example_wp_log_peyton_manning.csv.
+
+Usage (from TimeseriesFlaskDeploy, PYTHONPATH set by .envrc):
+  python bin/bench_cross_validation.py --workers 4
+"""
+import argparse
+import logging
+import time
+
+import pandas as pd
+from prophet import Prophet
+
+from model import model_validation
+
+data_filename = "./data/example_wp_log_peyton_manning.csv"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross validation benchmark")
+    parser.add_argument("--workers", type=int, default=model_validation.default_cv_workers,
+                        help=f"pool size (default: {model_validation.default_cv_workers})")
+    parser.add_argument("--initial", default=model_validation.default_cv_parameters["initial"])
+    parser.add_argument("--period", default=model_validation.default_cv_parameters["period"])
+    parser.add_argument("--horizon", default=model_validation.default_cv_parameters["horizon"])
+    args = parser.parse_args()
+    logging.getLogger("cmdstanpy").disabled = True  # one line per fit otherwise
+
+    m = Prophet()
+    m.fit(pd.read_csv(data_filename))
+    cv = {"initial": args.initial, "period": args.period, "horizon": args.horizon}
+    print(f"cutoffs: {cv} workers={args.workers}")
+    serial = None
+    for parallel in [None] + model_validation.parallel_modes:
+        start_time = time.time()
+        df_p = model_validation.cross_validate(m, parallel=parallel, workers=args.workers, **cv)
+        dt = time.time() - start_time
+        serial = dt if serial is None else serial
+        print(f"{str(parallel or 'serial'):10s} {dt:8.2f} s  x{serial / dt:4.1f}  "
+              f"mean mape={df_p['mape'].mean():.4f}")
+
+
+if __name__ == "__main__":
+    main()
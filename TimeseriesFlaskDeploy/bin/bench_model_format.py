@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+File size, write time and load time of a Prophet model in each storage format
+(model/model_format.py), fit on example_wp_log_peyton_manning.csv.
+
+Usage (from TimeseriesFlaskDeploy, PYTHONPATH set by .envrc):
+  python bin/bench_model_format.py --repeat 10
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import pandas as pd
+from prophet import Prophet
+
+from model import model_format
+
+data_filename = "./data/example_wp_log_peyton_manning.csv"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model storage format benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="writes and loads per format (default: 5)")
+    args = parser.parse_args()
+    logging.getLogger("cmdstanpy").disabled = True
+
+    m = Prophet()
+    m.fit(pd.read_csv(data_filename))
+    with tempfile.TemporaryDirectory() as path:
+        for fmt in model_format.available_formats():
+            start_time = time.time()
+            for _ in range(args.repeat):
+                file_name = model_format.dump_model(m, os.path.join(path, "model"), fmt)
+            write_time = (time.time() - start_time) / args.repeat
+            start_time = time.time()
+            for _ in range(args.repeat):
+                model_format.load_model(file_name)
+            load_time = (time.time() - start_time) / args.repeat
+            print(f"{fmt:10s} {os.path.getsize(file_name):10d} bytes  "
+                  f"write {write_time * 1000:8.1f} ms  load {load_time * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
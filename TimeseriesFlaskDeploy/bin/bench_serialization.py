@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Compare the old per-endpoint json.dumps(..., cls=NumpyArrayEncoder) responses with
+model/serialization.py on the two payloads that dominate serialization CPU:
+  - a Prophet forecast (ds + 15 float columns, as returned by /predict)
+  - a 10k-row classification response (as returned by SimpleTF /predict)
+
+Usage (from TimeseriesFlaskDeploy, PYTHONPATH set by .envrc):
+  python bin/bench_serialization.py --periods 3650 --repeat 20
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from model import serialization
+
+forecast_columns = [
+    'ds', 'trend', 'yhat_lower', 'yhat_upper', 'trend_lower', 'trend_upper',
+    'additive_terms', 'additive_terms_lower', 'additive_terms_upper',
+    'weekly', 'weekly_lower', 'weekly_upper', 'yearly', 'yearly_lower', 'yearly_upper', 'yhat']
+
+
+def forecast_payload(periods):
+    rng = np.random.default_rng(0)
+    forecast = pd.DataFrame(rng.normal(8, 1, size=(periods, len(forecast_columns) - 1)),
+                            columns=forecast_columns[1:])
+    forecast.insert(0, "ds", pd.date_range("2008-01-01", periods=periods, freq="D"))
+    return forecast
+
+
+def classification_payload(rows):
+    rng = np.random.default_rng(0)
+    return {"size": rows, "data": rng.integers(0, 2, size=rows), "model": "decision_tree"}
+
+
+def old_forecast(forecast):
+    return json.dumps({
+        "size": forecast.shape,
+        "data": forecast.to_numpy(),
+        "header": forecast.columns,
+        "model_id": "bench"
+    }, cls=serialization.NumpyArrayEncoder)
+
+
+def new_forecast(forecast):
+    return serialization.encode_body({
+        "size": forecast.shape,
+        "data": forecast,
+        "header": forecast.columns,
+        "model_id": "bench"
+    })[0]
+
+
+def old_classification(res):
+    return json.dumps(res, cls=serialization.NumpyArrayEncoder)
+
+
+def new_classification(res):
+    return serialization.encode_body(res)[0]
+
+
+def bench(name, fn, arg, repeat):
+    fn(arg)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = fn(arg)
+    dt = (time.perf_counter() - start) / repeat
+    print(f"{name:32s} {len(body):10d} bytes {1000. * dt:9.2f} ms {len(body) / dt / 1e6:9.1f} MB/s")
+    return dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON serialization benchmark")
+    parser.add_argument("--periods", type=int, default=3650, help="forecast rows (default: 3650)")
+    parser.add_argument("--rows", type=int, default=10000, help="classification rows (default: 10000)")
+    parser.add_argument("--repeat", type=int, default=20, help="timed repetitions (default: 20)")
+    args = parser.parse_args()
+    print(f"orjson {'available' if serialization.orjson is not None else 'NOT installed (json fallback)'}")
+    forecast = forecast_payload(args.periods)
+    res = classification_payload(args.rows)
+    t_old = bench("forecast, json + encoder", old_forecast, forecast, args.repeat)
+    t_new = bench("forecast, serialization", new_forecast, forecast, args.repeat)
+    print(f"forecast speedup x{t_old / t_new:.1f}")
+    t_old = bench("classification, json + encoder", old_classification, res, args.repeat)
+    t_new = bench("classification, serialization", new_classification, res, args.repeat)
+    print(f"classification speedup x{t_old / t_new:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ Based on the "Use the Service" section from Time Series Model Deploy Brownbag.ip
 import argparse
 import json
 import sys
+import time
 from datetime import datetime
 from pathlib import Path
 
@@ -50,12 +51,13 @@ class TimeSeriesClient:
         print(f"Received {len(data.get('data', []))} data points")
         return data
 
-    def train_model(self, training_data):
+    def train_model(self, training_data, poll_interval=2):
         """
         Train a new model with the provided data.
 
         Args:
             training_data: Dictionary with 'header' and 'data' keys
+            poll_interval: Seconds between training job status checks (default: 2)
 
         Returns:
             Dictionary with model_id and training metrics
@@ -65,12 +67,62 @@ class TimeSeriesClient:
         response = requests.post(url, json=training_data, timeout=self.timeout)
         response.raise_for_status()
         result = response.json()
+        if 'job_id' in result:
+            result = self.wait_for_job(result['job_id'], poll_interval)
+            if result['status'] != 'done':
+                raise RuntimeError(f"Training job {result['job_id']} failed: {result.get('error')}")
         print(f"Model trained successfully!")
         print(f"  Model ID: {result.get('model_id')}")
         print(f"  Training time: {result.get('training_time', 'N/A')} seconds")
         print(f"  Data size: {result.get('size', 'N/A')}")
         return result
 
+    def update_model(self, model_id, new_data, poll_interval=2):
+        """
+        Refit a model on its history plus new rows, warm started from the stored model.
+
+        Args:
+            model_id: The model to update
+            new_data: Dictionary with a 'data' key holding only the new [ds, y] rows
+            poll_interval: Seconds between training job status checks (default: 2)
+
+        Returns:
+            Dictionary with the new model_id and training metrics
+        """
+        print(f"Updating model {model_id}...")
+        url = f"{self.base_url}/train/{model_id}/update"
+        response = requests.post(url, json=new_data, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        if 'job_id' in result:
+            result = self.wait_for_job(result['job_id'], poll_interval)
+            if result['status'] != 'done':
+                raise RuntimeError(f"Training job {result['job_id']} failed: {result.get('error')}")
+        print(f"  New model ID: {result.get('model_id')}")
+        print(f"  Training time: {result.get('training_time', 'N/A')} seconds")
+        return result
+
+    def wait_for_job(self, job_id, poll_interval=2):
+        """
+        Poll a training job until it is done or failed.
+
+        Args:
+            job_id: The ID returned by /train
+            poll_interval: Seconds between status checks
+
+        Returns:
+            Final job status record
+        """
+        print(f"  Waiting for training job {job_id}...")
+        url = f"{self.base_url}/jobs/{job_id}"
+        while True:
+            response = requests.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            status = response.json()
+            if status['status'] in ('done', 'failed'):
+                return status
+            time.sleep(poll_interval)
+
     def validate_model(self, model_id):
         """
         Perform cross-validation on a trained model.
@@ -91,7 +143,7 @@ class TimeSeriesClient:
             print(f"  Metrics available: {list(result['metrics'].keys())}")
         return result
 
-    def predict(self, model_id, size=180, data=None):
+    def predict(self, model_id, size=180, data=None, columns=None, uncertainty=True):
         """
         Make predictions using a trained model.
 
@@ -99,6 +151,8 @@ class TimeSeriesClient:
             model_id: The ID of the model to use
             size: Number of future periods to predict (default: 180)
             data: Optional historical data for prediction base
+            columns: Optional forecast columns, a list or "forecast" (ds, yhat, yhat_lower, yhat_upper)
+            uncertainty: False skips the uncertainty intervals, much faster (default: True)
 
         Returns:
             Dictionary with prediction results
@@ -109,8 +163,11 @@ class TimeSeriesClient:
         payload = {
             "model_id": model_id,
             "size": size,
-            "data": data or []
+            "data": data or [],
+            "uncertainty": uncertainty
         }
+        if columns is not None:
+            payload["columns"] = columns
         response = requests.post(url, json=payload, timeout=self.timeout)
         response.raise_for_status()
         result = response.json()
@@ -0,0 +1,114 @@
+"""
+Many named series in one request, for /train/batch and /predict/batch.
+
+Series arrive either as a JSON (or MessagePack) mapping {"series": {name: [[ds, y], ...]}}
+or as one long table with columns series, ds, y in an Arrow stream or a Parquet file
+(Content-Type application/vnd.apache.parquet, needs pyarrow); other fields then come
+from the query string.
+
+Batch forecasts are kept in the forecast cache per model, and batches with at least
+BATCH_POOL_MIN_SERIES uncached series are predicted on the worker's batch pool (see jobs.py).
+"""
+import io
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+from werkzeug.exceptions import BadRequest
+
+import forecast_cache
+import jobs
+import serialization
+import training_data
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+PARQUET = "application/vnd.apache.parquet"
+# uncached series of a /predict/batch from which they are predicted on the batch pool
+pool_min_series = int(os.getenv("BATCH_POOL_MIN_SERIES", "4"))
+
+
+def decode_series(req):
+    """
+    :return: the request document, {name: pd.DataFrame with columns ds, y}
+    """
+    if req.mimetype == PARQUET:
+        if pq is None:
+            raise BadRequest("Parquet bodies need pyarrow")
+        records = dict(req.args)
+        try:
+            records["data"] = pq.read_table(io.BytesIO(req.get_data())).to_pandas()
+        except (ValueError, OSError) as e:
+            raise BadRequest(f"could not decode {PARQUET} body: {e}")
+    else:
+        # a .npy array has no series column
+        records = serialization.decode_request(
+            req, formats=[serialization.JSON, serialization.MSGPACK, serialization.ARROW])
+    if isinstance(records.get("series"), dict):
+        frames = {str(name): training_data.training_frame(data) for name, data in records["series"].items()}
+    elif isinstance(records.get("data"), pd.DataFrame) and "series" in records["data"].columns:
+        frames = {str(name): training_data.training_frame(group)
+                  for name, group in records["data"].groupby("series", sort=False)}
+    else:
+        raise BadRequest('send {"series": {name: [[ds, y], ...]}} or a table with columns series, ds, y')
+    empty = [name for name, df in frames.items() if len(df) == 0]
+    if len(empty) > 0:
+        raise BadRequest(f"no training data for series {empty}")
+    return records, frames
+
+
+def forecast_series(model_id, periods, uncertainty=True, columns=None):
+    """
+    :return: forecast pd.DataFrame of the model's history plus periods, also run in the pool
+    """
+    m = training_data.get_model(model_id)
+    return training_data.forecast_frame(m, m.make_future_dataframe(periods=periods), uncertainty, columns)
+
+
+def forecast_models(models, periods, uncertainty=True, columns=None):
+    """
+    :param models: {name: model_id}
+    :return: {name: forecast pd.DataFrame} in the order of models, {name: error} of unknown models;
+        raises ValueError for unknown columns
+    """
+    forecasts, errors, pending = {}, {}, {}
+    for name, model_id in models.items():
+        key = forecast_cache.forecast_key(model_id, periods=periods, columns=columns,
+                                          uncertainty=uncertainty, fmt="frame")
+        forecasts[name] = forecast_cache.get_frame(model_id, key)
+        if forecasts[name] is None:
+            pending[name] = (model_id, key)
+    futures = {}
+    if len(pending) >= pool_min_series:
+        futures = {name: jobs.submit_batch_work(forecast_series, model_id, periods, uncertainty, columns)
+                   for name, (model_id, _) in pending.items()}
+    for name, (model_id, key) in pending.items():
+        try:
+            try:
+                forecasts[name] = futures[name].result() if name in futures else None
+            except BrokenProcessPool:
+                forecasts[name] = None  # a pool process died meanwhile, the next batch gets a new pool
+            if forecasts[name] is None:
+                forecasts[name] = forecast_series(model_id, periods, uncertainty, columns)
+        except FileNotFoundError:
+            errors[name] = f"unknown model {model_id}"
+            continue
+        forecast_cache.put_frame(model_id, key, forecasts[name])
+    return {name: f for name, f in forecasts.items() if name not in errors}, errors
+
+
+def concat_forecasts(forecasts):
+    """
+    :param forecasts: {name: forecast pd.DataFrame}
+    :return: one long pd.DataFrame with the series name as its first column,
+        {name: [first row, end row]} of each series in it
+    """
+    index, start = {}, 0
+    for name, forecast in forecasts.items():
+        index[name] = [start, start + len(forecast)]
+        start += len(forecast)
+    frame = pd.concat([f.assign(series=name) for name, f in forecasts.items()], ignore_index=True)
+    return frame[["series"] + [c for c in frame.columns if c != "series"]], index
@@ -0,0 +1,76 @@
+import json
+import os
+from hashlib import sha1
+
+import training_data
+from model_cache import LRUCache
+
+# encoded /predict responses, a persisted model always produces the same forecast
+cache = LRUCache(max_bytes=int(os.getenv("FORECAST_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+                 ttl=None)
+# also keep the encoded responses next to the pickles, shared by workers and pods
+persist = os.getenv("FORECAST_CACHE_DISK", "false").lower() in ("1", "true", "yes")
+
+
+def forecast_key(model_id, **params):
+    """
+    :param params: everything that shapes the response (horizon, columns, format, ...)
+    :return: cache key
+    """
+    spec = json.dumps(params, sort_keys=True, default=str)
+    return model_id + "-" + sha1(spec.encode("utf-8")).hexdigest()[:20]
+
+
+def _file_name(key):
+    return training_data.model_pickle_path + "forecasts/" + key + ".bin"
+
+
+def get(model_id, key):
+    """
+    :return: (body, content type, headers) or None
+    """
+    try:
+        stamp = training_data.model_stamp(model_id)
+    except FileNotFoundError:
+        return None
+    entry = cache.get(key, stamp)
+    if entry is None and persist and os.path.exists(_file_name(key)):
+        with open(_file_name(key), "rb") as infile:
+            meta = json.loads(infile.readline())
+            body = infile.read()
+        if tuple(meta["stamp"]) == stamp:
+            entry = (body, meta["content_type"], [tuple(h) for h in meta["headers"]])
+            cache.put(key, entry, len(body), stamp)
+    return entry
+
+
+def put(model_id, key, body, content_type, headers):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    stamp = training_data.model_stamp(model_id)
+    cache.put(key, (body, content_type, headers), len(body), stamp)
+    if persist:
+        file_name = _file_name(key)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        meta = {"stamp": stamp, "content_type": content_type, "headers": headers}
+        tmp_file_name = f"{file_name}.{os.getpid()}.tmp"
+        with open(tmp_file_name, "wb") as outfile:
+            outfile.write(json.dumps(meta).encode("utf-8") + b"\n")
+            outfile.write(body)
+        os.replace(tmp_file_name, file_name)  # readers never see a partial file
+
+
+def get_frame(model_id, key):
+    """
+    :return: a forecast pd.DataFrame kept by put_frame (/predict/batch), or None
+    """
+    try:
+        stamp = training_data.model_stamp(model_id)
+    except FileNotFoundError:
+        return None
+    return cache.get(key, stamp)
+
+
+def put_frame(model_id, key, frame):
+    # only in this worker's memory, the batch table is encoded after the frames are joined
+    cache.put(key, frame, int(frame.memory_usage(deep=True).sum()), training_data.model_stamp(model_id))
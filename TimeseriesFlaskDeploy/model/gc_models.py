@@ -0,0 +1,131 @@
+"""
+Evict models from the model storage, least recently used first.
+
+A model is its pickle plus everything stored under its model_id (cross validation
+metrics, cached forecasts). Last use is the access time get_model records on the pickle.
+With --max-age-days, training job records (jobs/) and the *.tmp files of interrupted
+writes not modified within the same number of days are removed as well.
+
+Usage (in the container, from /model):
+  python gc_models.py --max-bytes 8000000
+  python gc_models.py --max-age-days 30 --dry-run
+"""
+import argparse
+import os
+import re
+import time
+
+import training_data
+
+_model_file = re.compile(r"^([0-9a-f]{40})[.-]")
+
+
+def stored_models(path=None):
+    """
+    :return: {model_id: {"files": [...], "bytes": total size, "last_used": atime}}
+    """
+    if path is None:
+        path = training_data.model_pickle_path
+    models = {}
+    for directory in [path, os.path.join(path, "forecasts")]:
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            match = _model_file.match(name)
+            if match is None or name.endswith(".tmp"):
+                continue
+            file_name = os.path.join(directory, name)
+            st = os.stat(file_name)
+            model = models.setdefault(match.group(1), {"files": [], "bytes": 0, "last_used": 0.})
+            model["files"].append(file_name)
+            model["bytes"] += st.st_size
+            model["last_used"] = max(model["last_used"], st.st_atime)
+    return models
+
+
+def collect_garbage(max_bytes=None, max_age_days=None, path=None, dry_run=False):
+    """
+    Evict models unused for more than max_age_days, then the least recently used
+    ones until the storage holds at most max_bytes
+    :return: list of evicted model ids
+    """
+    models = stored_models(path)
+    lru = sorted(models, key=lambda model_id: models[model_id]["last_used"])
+    total = sum(m["bytes"] for m in models.values())
+    evicted = []
+    for model_id in lru:
+        too_old = max_age_days is not None and \
+            time.time() - models[model_id]["last_used"] > max_age_days * 86400
+        too_big = max_bytes is not None and total > max_bytes
+        if not (too_old or too_big):
+            continue
+        evicted.append(model_id)
+        total -= models[model_id]["bytes"]
+        if not dry_run:
+            for file_name in models[model_id]["files"]:
+                try:
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    pass  # another pod collected it first
+    return evicted
+
+
+def stale_files(max_age_days, path=None):
+    """
+    :return: job records and *.tmp files (e.g. of a worker killed mid-write) not modified
+        for more than max_age_days
+    """
+    if path is None:
+        path = training_data.model_pickle_path
+    cutoff = time.time() - max_age_days * 86400
+    files = []
+    for directory in [path, os.path.join(path, "forecasts"), os.path.join(path, "jobs")]:
+        if not os.path.isdir(directory):
+            continue
+        is_job_record = os.path.basename(directory) == "jobs"
+        for name in os.listdir(directory):
+            file_name = os.path.join(directory, name)
+            if (is_job_record or name.endswith(".tmp")) and os.path.isfile(file_name) and \
+                    os.stat(file_name).st_mtime < cutoff:
+                files.append(file_name)
+    return files
+
+
+def collect_stale_files(max_age_days, path=None, dry_run=False):
+    """
+    Remove the job records and *.tmp files older than max_age_days
+    :return: list of removed files
+    """
+    files = stale_files(max_age_days, path)
+    if not dry_run:
+        for file_name in files:
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass  # another pod collected it first
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evict least recently used models from the model storage")
+    parser.add_argument("--path", default=training_data.model_pickle_path,
+                        help=f"model storage (default: {training_data.model_pickle_path})")
+    parser.add_argument("--max-bytes", type=int, help="size budget of the model storage")
+    parser.add_argument("--max-age-days", type=float, help="evict models not used for this many days, remove older job records and *.tmp files")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be evicted")
+    args = parser.parse_args()
+    if args.max_bytes is None and args.max_age_days is None:
+        parser.error("give --max-bytes and/or --max-age-days")
+    models = stored_models(args.path)
+    evicted = collect_garbage(args.max_bytes, args.max_age_days, args.path, args.dry_run)
+    for model_id in evicted:
+        print(f"{'would evict' if args.dry_run else 'evicted'} {model_id} ({models[model_id]['bytes']} bytes)")
+    print(f"{len(evicted)} of {len(models)} models, "
+          f"{sum(m['bytes'] for i, m in models.items() if i not in evicted)} bytes kept")
+    if args.max_age_days is not None:
+        files = collect_stale_files(args.max_age_days, args.path, args.dry_run)
+        print(f"{'would remove' if args.dry_run else 'removed'} {len(files)} job records and temporary files")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+import json
+import multiprocessing
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from prophet import Prophet
+
+import model_validation
+import training_data
+
+# concurrent Prophet fits per uWSGI worker
+training_workers = int(os.getenv("TRAINING_WORKERS", "1"))
+# processes per uWSGI worker for the series of /train/batch with wait and of /predict/batch
+batch_workers = int(os.getenv("BATCH_WORKERS", str(os.cpu_count() or 1)))
+# a queued job older than this is taken as lost (e.g. its worker was killed), identical
+# submissions then start a new one instead of waiting on it
+job_timeout_sec = float(os.getenv("TRAINING_JOB_TIMEOUT_SEC", "3600"))
+# compute and store the default cross validation metrics right after each fit
+validate_after_training = os.getenv("VALIDATE_AFTER_TRAINING", "false").lower() in ("1", "true", "yes")
+
+_executors = {}  # pool name -> (pid of the worker that created it, ProcessPoolExecutor)
+
+
+def _jobs_path():
+    # job records live next to the models so every worker (and pod) can answer /jobs/<id>
+    return training_data.model_pickle_path + "jobs/"
+
+
+def _write_status(status):
+    os.makedirs(_jobs_path(), exist_ok=True)
+    file_name = _jobs_path() + status["job_id"] + ".json"
+    tmp_file_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(tmp_file_name, "w") as outfile:
+        json.dump(status, outfile)
+    os.replace(tmp_file_name, file_name)
+    return status
+
+
+def job_status(job_id):
+    """
+    :return: status record of the job, None for an unknown job id
+    """
+    try:
+        with open(_jobs_path() + job_id + ".json", "r") as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return None
+
+
+def _inflight_file(model_id):
+    return _jobs_path() + model_id + ".inflight"
+
+
+def _inflight_job(model_id):
+    """
+    :return: id of the unfinished job that fits model_id, its status record; None, None if there is none
+    """
+    try:
+        with open(_inflight_file(model_id), "r") as infile:
+            job_id = infile.read().strip()
+    except FileNotFoundError:
+        return None, None
+    status = job_status(job_id)
+    if status is None or status["status"] in ("done", "failed") or \
+            time.time() - status["submitted"] > job_timeout_sec:
+        return job_id, None
+    return job_id, status
+
+
+def _claim(model_id, job_id):
+    """
+    Make job_id the job that fits model_id, across workers and pods sharing the storage
+    :return: None, or the status record of the unfinished job that already fits it
+    """
+    stale_job_id, status = _inflight_job(model_id)
+    if status is not None:
+        return status
+    if stale_job_id is not None:
+        _release(model_id, stale_job_id)
+    try:
+        # O_EXCL: of two identical submissions only one creates the file
+        fd = os.open(_inflight_file(model_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return _inflight_job(model_id)[1] or _claim(model_id, job_id)
+    with os.fdopen(fd, "w") as outfile:
+        outfile.write(job_id)
+    return None
+
+
+def _release(model_id, job_id):
+    try:
+        with open(_inflight_file(model_id), "r") as infile:
+            if infile.read().strip() != job_id:
+                return  # taken over by a newer job
+        os.remove(_inflight_file(model_id))
+    except FileNotFoundError:
+        pass
+
+
+def _executor_for_this_process(name="training"):
+    """
+    :param name: training (queued jobs, TRAINING_WORKERS) or batch (BATCH_WORKERS)
+    """
+    # the pool cannot be shared across uWSGI's fork, create it in the worker that uses it;
+    # fork (not spawn) because under uWSGI sys.executable is the uwsgi binary
+    pid, executor = _executors.get(name, (None, None))
+    if executor is None or pid != os.getpid():
+        workers = training_workers if name == "training" else batch_workers
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+        _executors[name] = (os.getpid(), executor)
+    return executor
+
+
+def _submit(name, fn, *args):
+    """
+    Submit to this worker's pool; a pool that lost a process (e.g. killed for memory) stays
+    broken for good, it is replaced once
+    :return: Future
+    """
+    try:
+        return _executor_for_this_process(name).submit(fn, *args)
+    except BrokenProcessPool:
+        pid, executor = _executors.pop(name)
+        executor.shutdown(wait=False)
+        return _executor_for_this_process(name).submit(fn, *args)
+
+
+def submit_batch_work(fn, *args):
+    """
+    Run fn(*args) on this worker's pool for the series of a batch request, apart from the queued jobs
+    :return: Future
+    """
+    return _submit("batch", fn, *args)
+
+
+def stan_init(m):
+    """
+    :param m: fitted Prophet model
+    :return: its fitted parameters, the starting point for the optimizer of a refit,
+        and the names of the features beta weighs (see _warm_start)
+    """
+    res = {}
+    for pname in ["k", "m", "sigma_obs"]:
+        res[pname] = float(m.params[pname][0][0])
+    for pname in ["delta", "beta"]:
+        res[pname] = m.params[pname][0]
+    res["beta_columns"] = list(m.make_all_seasonality_features(m.history)[0].columns)
+    return res
+
+
+def _warm_start(init, df, params=None):
+    """
+    :param init: stan_init() of the base model
+    :return: the Stan init for a fit of df; beta (delta) starts from zero when the fit has other
+        seasonality, holiday or regressor features (changepoints) than the base model
+    """
+    init = dict(init)
+    beta_columns = init.pop("beta_columns", None)
+    # what fit sets up before it calls Stan, e.g. yearly seasonality once the history spans two years
+    probe = Prophet(**(params or {}))
+    probe.history = probe.setup_dataframe(df[df["y"].notnull()].copy(), initialize_scales=True)
+    probe.set_auto_seasonalities()
+    probe.set_changepoints()
+    columns = list(probe.make_all_seasonality_features(probe.history)[0].columns)
+    if columns != beta_columns:
+        init["beta"] = np.zeros(len(columns))
+    if len(init["delta"]) != len(probe.changepoints_t):
+        init["delta"] = np.zeros(len(probe.changepoints_t))
+    return init
+
+
+def fit_model(df, params=None, fmt=None, init=None):
+    """
+    Fit and persist a Prophet model (in the calling process); data and hyperparameters
+    that were trained on before return the stored model without fitting
+    :param params: keyword arguments for Prophet()
+    :param fmt: storage format (see model_format.py), default MODEL_FORMAT
+    :param init: warm start, stan_init() of a model fit with the same params
+    :return: model_id, training time in seconds, whether the model already existed
+    """
+    model_id = training_data.model_id_for(df, params)
+    if training_data.model_exists(model_id):
+        return model_id, 0., True
+    start_time = time.time()
+    m = Prophet(**(params or {}))
+    if init is None:
+        m.fit(df)
+    else:
+        m.fit(df, init=_warm_start(init, df, params))
+    train_time = time.time() - start_time
+    training_data.persist_model(m, model_id, fmt)
+    training_data.persist_params(model_id, params)
+    return model_id, train_time, False
+
+
+def fit_models(frames, params=None, fmt=None):
+    """
+    Fit and persist one model per series on the batch pool, waiting for all of them
+    :param frames: {name: pd.DataFrame with columns ds, y}
+    :return: {name: (model_id, training time in seconds, whether the model already existed)},
+        {name: error} of the series that failed
+    """
+    futures = {name: submit_batch_work(fit_model, df, params, fmt) for name, df in frames.items()}
+    results, errors = {}, {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            errors[name] = repr(e)
+    return results, errors
+
+
+def validate_model(model_id, m):
+    """
+    Compute and store the default cross validation metrics of a model
+    """
+    cv = model_validation.default_cv_parameters
+    start_time = time.time()
+    df_p = model_validation.cross_validate(m, **cv)
+    training_data.persist_metrics(model_id, cv, df_p, time.time() - start_time)
+
+
+def _run_training(status, df, params=None, fmt=None, validate=False, init=None):
+    status = _write_status(dict(status, status="running", started=time.time()))
+    try:
+        model_id, train_time, _ = fit_model(df, params, fmt, init)
+    except Exception as e:
+        _write_status(dict(status, status="failed", finished=time.time(), error=repr(e)))
+        _release(status["model_id"], status["job_id"])
+        raise
+    # the model is stored, new submissions of the same input find it from now on
+    _release(model_id, status["job_id"])
+    status = dict(status, training_time=round(train_time, 3))
+    if validate:
+        _write_status(dict(status, status="validating"))
+        try:
+            validate_model(model_id, training_data.get_model(model_id))
+        except Exception as e:  # the model is stored and usable, e.g. too little history for the cutoffs
+            status["validation_error"] = repr(e)
+    return _write_status(dict(status, status="done", finished=time.time()))
+
+
+def _check_failure(status):
+    def callback(future):
+        e = future.exception()
+        if e is None:
+            return
+        record = job_status(status["job_id"])
+        if record is None or record["status"] != "failed":
+            # e.g. the pool process died before it could record anything
+            _write_status(dict(status, status="failed", finished=time.time(), error=repr(e)))
+        _release(status["model_id"], status["job_id"])
+    return callback
+
+
+def submit_training(df, params=None, fmt=None, validate=False, init=None):
+    """
+    Queue a training job on the local process pool
+    :param df: pd.DataFrame with columns ds, y
+    :param params: keyword arguments for Prophet()
+    :param fmt: storage format (see model_format.py), default MODEL_FORMAT
+    :param validate: also store the default cross validation metrics once the model is fit
+    :param init: warm start, stan_init() of a model fit with the same params
+    :return: status record with the job_id and the model_id the model will be stored under;
+        for data and hyperparameters seen before the record is already done, and while the
+        same input is queued or running it is that job's record
+    """
+    status = {
+        "job_id": uuid.uuid4().hex,
+        "model_id": training_data.model_id_for(df, params),
+        "status": "queued",
+        "size": list(df.shape),
+        "warm_start": init is not None,
+        "submitted": time.time()}
+    if training_data.model_exists(status["model_id"]):
+        return _write_status(dict(status, status="done", finished=status["submitted"],
+                                  training_time=0., existing=True))
+    _write_status(status)
+    inflight = _claim(status["model_id"], status["job_id"])
+    if inflight is not None:
+        os.remove(_jobs_path() + status["job_id"] + ".json")  # never handed out
+        return inflight
+    try:
+        future = _submit("training", _run_training, status, df, params, fmt, validate, init)
+    except Exception as e:  # even a new pool could not take it, e.g. out of memory
+        _release(status["model_id"], status["job_id"])
+        return _write_status(dict(status, status="failed", finished=time.time(), error=repr(e)))
+    future.add_done_callback(_check_failure(status))
+    return status
+
+
+def submit_batch(frames, params=None, fmt=None, validate=False):
+    """
+    Queue one training job per series
+    :param frames: {name: pd.DataFrame with columns ds, y}
+    :return: {name: status record}
+    """
+    return {name: submit_training(df, params, fmt, validate) for name, df in frames.items()}
@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Per-process LRU cache bounded by the total byte size of its entries.
+
+    Every entry carries a stamp (e.g. the mtime and size of the file it was loaded
+    from); a get with a different stamp counts as an invalidation and misses.
+    Entries older than ttl seconds miss as well.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, nbytes, stamp, stored_at)
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def _drop(self, key):
+        _, nbytes, _, _ = self._entries.pop(key)
+        self.nbytes -= nbytes
+
+    def get(self, key, stamp=None):
+        """
+        :return: the cached value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, _, _stamp, stored_at = entry
+                if _stamp != stamp:
+                    self.counters["invalidations"] += 1
+                    self._drop(key)
+                elif self.ttl is not None and time.time() - stored_at > self.ttl:
+                    self.counters["expirations"] += 1
+                    self._drop(key)
+                else:
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return value
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key, value, nbytes, stamp=None):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if nbytes > self.max_bytes:
+                return  # would evict everything else and still not fit
+            self._entries[key] = (value, nbytes, stamp, time.time())
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "ttl_sec": self.ttl,
+                **self.counters
+            }
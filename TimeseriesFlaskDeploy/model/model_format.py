@@ -0,0 +1,105 @@
+"""
+On-disk formats for Prophet models.
+
+  joblib    the pickled Prophet object (.pkl), the original format
+  json      Prophet's own JSON serialization (.json), no Stan fit artifacts or pickled code
+  json.gz   the same, gzip compressed
+  json.zst  the same, zstd compressed (needs zstandard)
+  json.lz4  the same, lz4 compressed (needs lz4)
+
+The JSON formats keep the training history because make_future_dataframe and
+the uncertainty intervals need it.
+"""
+import gzip
+import os
+
+from joblib import dump, load
+from prophet.serialize import model_from_json, model_to_json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+extensions = {
+    "joblib": ".pkl",
+    "json": ".json",
+    "json.gz": ".json.gz",
+    "json.zst": ".json.zst",
+    "json.lz4": ".json.lz4"
+}
+
+
+def available_formats():
+    formats = ["joblib", "json", "json.gz"]
+    if zstandard is not None:
+        formats.append("json.zst")
+    if lz4 is not None:
+        formats.append("json.lz4")
+    return formats
+
+
+def _compress(data, fmt):
+    if fmt == "json.gz":
+        return gzip.compress(data, compresslevel=6)
+    elif fmt == "json.zst":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif fmt == "json.lz4":
+        return lz4.frame.compress(data)
+    return data
+
+
+def _decompress(data, fmt):
+    if fmt == "json.gz":
+        return gzip.decompress(data)
+    elif fmt == "json.zst":
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif fmt == "json.lz4":
+        return lz4.frame.decompress(data)
+    return data
+
+
+def format_of(file_name):
+    for fmt, ext in sorted(extensions.items(), key=lambda x: -len(x[1])):
+        if file_name.endswith(ext):
+            return fmt
+    raise ValueError(f"unknown model file format {file_name}")
+
+
+def dump_model(model, file_name_base, fmt="joblib"):
+    """
+    Write the model to file_name_base + the format's extension; readers never see a partial file
+    :return: the file name
+    """
+    if fmt not in available_formats():
+        raise ValueError(f"model format should be one of {available_formats()}, got {fmt}")
+    file_name = file_name_base + extensions[fmt]
+    tmp_file_name = f"{file_name}.{os.getpid()}.tmp"
+    if fmt == "joblib":
+        dump(model, filename=tmp_file_name)
+    else:
+        with open(tmp_file_name, "wb") as outfile:
+            outfile.write(_compress(model_to_json(model).encode("utf-8"), fmt))
+    os.replace(tmp_file_name, file_name)
+    return file_name
+
+
+def load_model_sized(file_name):
+    """
+    :return: the model, the byte size of its uncompressed serialization (close to its size
+        in memory, unlike the size of a compressed file)
+    """
+    fmt = format_of(file_name)
+    if fmt == "joblib":
+        return load(file_name), os.path.getsize(file_name)
+    with open(file_name, "rb") as infile:
+        data = _decompress(infile.read(), fmt)
+    return model_from_json(data.decode("utf-8")), len(data)
+
+
+def load_model(file_name):
+    return load_model_sized(file_name)[0]
@@ -2,15 +2,18 @@ __version__ = '0.2.1'
 
 import time
 
-from flask import Flask, Response, request
+from flask import Flask, request
 from logging.config import dictConfig
 
-from prophet import Prophet
-from prophet.diagnostics import performance_metrics
-from prophet.diagnostics import cross_validation
-
 # data management utilities
 from training_data import *
+import batch
+import forecast_cache
+import jobs
+import model_format
+import model_validation
+import serialization
+import streaming
 
 dictConfig({
     'version': 1,
@@ -32,128 +35,371 @@ app = Flask(__name__)
 
 @app.route('/version')
 def version():
-    rdata = json.dumps({
+    return serialization.make_response({
         "version": __version__,
         "date": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")})
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
 
 
 @app.route('/train', methods=['POST'])
 def train():
     """
+    Request and response may also use .npy, Arrow or MessagePack (see serialization.py).
     JSON Post Payload:
     { "size": 4,
+      "wait": false,  (optional, true fits synchronously in this worker as before)
+      "validate": false,  (optional, true stores default cross validation metrics after the fit)
+      "params": {"seasonality_mode": "multiplicative"},  (optional keyword arguments for Prophet)
+      "format": "json.zst",  (optional storage format, see model_format.py; default MODEL_FORMAT)
       "data": [
             [datetime1, y1],
             [datetime2, y2],
             ...
         ]
     }
-    :return: {'size': [2905, 2], 'training_time': 1.189, 'model_id': 'd61743627c2fb7f55fe1f7544ef887ced5e7141e'}
-    """
-    records = request.get_json()  # get the input parameters
-    periods = int(records["size"][0])
-    assert (periods > 0)  # much too forgiving!
-    vector_length = int(records["size"][1])
-    assert (vector_length == 2)
-    data = np.array(records["data"])
+    Training runs on a local process pool (see jobs.py); poll /jobs/<job_id> until status is done.
+    :return: {'job_id': '1b0c...', 'model_id': 'd61743627c2fb7f55fe1f7544ef887ced5e7141e', 'status': 'queued', ...}
+        or with wait: {'size': [2905, 2], 'training_time': 1.189, 'model_id': 'd61743627c2fb7f55fe1f7544ef887ced5e7141e'}
+    """
+    records = serialization.decode_request(request)  # get the input parameters
+    # create training data frame
+    df = training_frame(records["data"])
+    size = records.get("size", list(df.shape))
+    assert (len(df) > 0)  # much too forgiving!
     # TODO:
     # Train should save a data sample from training if
     # we want the example endpoint to work in the context of
     # specific model?
-    start_time = time.time()  # Time training and log it
-    # create training data frame
-    df = pd.DataFrame(data, columns=['ds', 'y'])
-    m = Prophet()  # model
-    m.fit(df)  # model fit
-    train_time = time.time() - start_time
-    # keep track of the id of the model that we fit so the correct model is used
-    # for validation and predictions!
-    model_id = persist_model(m)
-    rdata = json.dumps({
-        "size": records["size"],
-        "training_time": round(train_time, 3),
-        "model_id": model_id})
-    app.logger.info(f"model_server version = {__version__} model_id = {model_id} trained in {train_time} sec")
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+    params = records.get("params") or {}
+    return _train(records, df, size, params)
+
+
+@app.route('/train/<model_id>/update', methods=['POST'])
+def train_update(model_id):
+    """
+    Refit a stored model on its history plus new rows, starting the optimizer from the
+    stored model's fitted parameters; the result is stored under a new model_id.
+    JSON Post Payload:
+    { "wait": false,  (optional, as for /train)
+      "validate": false,  (optional, as for /train)
+      "format": "json.zst",  (optional, as for /train)
+      "params": {...},  (optional, only used for models stored before their hyperparameters were recorded)
+      "data": [
+            [datetime1, y1],  (only the new rows, a row with a ds already in the history replaces it)
+            ...
+        ]
+    }
+    :return: as for /train, plus the base_model_id
+    """
+    records = serialization.decode_request(request)
+    if not isinstance(records, dict) or records.get("data") is None or len(records["data"]) == 0:
+        return serialization.make_response({"errors": ["send the new [ds, y] rows in data"]}, status=400)
+    try:
+        base = get_model(model_id)
+    except FileNotFoundError:
+        return serialization.make_response({"errors": [f"unknown model {model_id}"]}, status=404)
+    try:
+        df = merge_history(base, records["data"])
+    except (ValueError, TypeError) as e:
+        return serialization.make_response({"errors": [f"could not read the new rows: {e}"]}, status=400)
+    params = get_params(model_id)
+    if params is None:
+        params = records.get("params") or {}
+    return _train(records, df, list(df.shape), params, init=jobs.stan_init(base),
+                  extra={"base_model_id": model_id})
+
+
+def _train(records, df, size, params, init=None, extra=None):
+    storage_format = records.get("format")
+    if storage_format is not None and storage_format not in model_format.available_formats():
+        return serialization.make_response(
+            {"errors": [f"format should be one of {model_format.available_formats()}"]}, status=400)
+    fmt = serialization.response_format(request)
+    if str(records.get("wait", False)).lower() in ("1", "true"):
+        # keep track of the id of the model that we fit so the correct model is used
+        # for validation and predictions!
+        model_id, train_time, existing = jobs.fit_model(df, params, storage_format, init)
+        res = {
+            "size": size,
+            "training_time": round(train_time, 3),
+            "model_id": model_id,
+            "existing": existing,
+            **(extra or {})}
+        app.logger.info(f"model_server version = {__version__} model_id = {model_id} trained in {train_time} sec")
+        return serialization.make_response(res, fmt)
+    validate = str(records.get("validate", jobs.validate_after_training)).lower() in ("1", "true")
+    res = dict(jobs.submit_training(df, params, storage_format, validate, init), **(extra or {}))
+    app.logger.info(f"model_server version = {__version__} model_id = {res['model_id']} queued as job {res['job_id']}")
+    if res["status"] == "failed":
+        return serialization.make_response(res, fmt, status=500)
+    return serialization.make_response(res, fmt, status=200 if res.get("existing") else 202)
+
+
+@app.route('/train/batch', methods=['POST'])
+def train_batch():
+    """
+    Fit one model per named series on the local process pool (see batch.py for Arrow and Parquet uploads).
+    JSON Post Payload:
+    { "wait": false,  (optional, true waits for all fits)
+      "validate": false,  (optional, as for /train)
+      "params": {...},  (optional, as for /train, the same for every series)
+      "format": "json.zst",  (optional, as for /train)
+      "series": {
+            "name1": [[datetime1, y1], [datetime2, y2], ...],
+            "name2": [...],
+            ...
+        }
+    }
+    :return: {"models": {"name1": model_id, ...}, "jobs": {"name1": job_id, ...}, "size": 2}
+        or with wait: {"models": {...}, "training_time": {"name1": 1.189, ...}, "errors": {...}, "size": 2}
+    """
+    records, frames = batch.decode_series(request)
+    params = records.get("params") or {}
+    storage_format = records.get("format")
+    if storage_format is not None and storage_format not in model_format.available_formats():
+        return serialization.make_response(
+            {"errors": [f"format should be one of {model_format.available_formats()}"]}, status=400)
+    fmt = serialization.response_format(request)
+    if str(records.get("wait", False)).lower() in ("1", "true"):
+        start_time = time.time()
+        results, errors = jobs.fit_models(frames, params, storage_format)
+        res = {
+            "size": len(frames),
+            "models": {name: r[0] for name, r in results.items()},
+            "training_time": {name: round(r[1], 3) for name, r in results.items()},
+            "existing": [name for name, r in results.items() if r[2]],
+            "errors": errors}
+        app.logger.info(f"model_server version = {__version__} trained {len(results)} series "
+                        f"in {time.time() - start_time} sec, {len(errors)} failed")
+        # every fit failed, e.g. series too short for Prophet: the per-series errors say why
+        return serialization.make_response(res, fmt, status=200 if len(results) > 0 else 400)
+    validate = str(records.get("validate", jobs.validate_after_training)).lower() in ("1", "true")
+    statuses = jobs.submit_batch(frames, params, storage_format, validate)
+    res = {
+        "size": len(frames),
+        "models": {name: status["model_id"] for name, status in statuses.items()},
+        "jobs": {name: status["job_id"] for name, status in statuses.items()},
+        "existing": [name for name, status in statuses.items() if status.get("existing")]}
+    app.logger.info(f"model_server version = {__version__} queued {len(frames)} series")
+    return serialization.make_response(res, fmt, status=202)
+
+
+@app.route('/jobs/<job_id>')
+def job(job_id):
+    """
+    :return: status record of a training job, status is one of queued, running, done, failed
+    """
+    res = jobs.job_status(job_id)
+    if res is None:
+        return serialization.make_response({"errors": [f"unknown job {job_id}"]}, status=404)
+    return serialization.make_response(res)
+
+
+def _forecast_options(records):
+    """
+    :return: requested forecast columns (None for all, a list or "forecast"), whether to compute intervals
+    """
+    columns = records.get("columns")
+    if isinstance(columns, str) and columns != "forecast":
+        columns = columns.split(",")  # from the query string
+    uncertainty = str(records.get("uncertainty", True)).lower() not in ("0", "false", "no")
+    return columns, uncertainty
 
 
 @app.route('/predict', methods=['POST'])
 def predict():
     """
+    Request and response may also use .npy, Arrow or MessagePack (see serialization.py).
     JSON Post Payload:
-    { "size": 4,
+    { "size": 4,  (periods past the history, used when neither data nor range is given)
       "model_id": "asd98f7a9s8df79ads",
-      "data": [
+      "columns": ["ds", "yhat"],  (optional, default all forecast columns; "forecast" for ds, yhat, yhat_lower, yhat_upper)
+      "uncertainty": false,  (optional, true by default; false skips the interval simulation)
+      "range": {"start": "2016-02-01", "periods": 30, "freq": "D"},  (optional, arguments of pd.date_range)
+      "data": [  (optional, the datetimes to forecast)
             [datetime1],
             [datetime2],
             ...
         ]
     }
+    Without data or range the forecast covers the whole history plus size periods.
+    Encoded responses are cached per model, targets, columns, uncertainty and format (see forecast_cache.py).
+    With Accept: application/x-ndjson or text/csv (or "stream": "ndjson" / "csv") the forecast is
+    predicted and sent in blocks of rows instead (see streaming.py), bypassing the cache.
     :return:
     """
-    records = request.get_json()
-    res = np.array(records["data"])
-    periods = int(records["size"])
+    records = serialization.decode_request(request)
     model_id = records["model_id"]
-    m = get_model(model_id)
-    if len(res) == 0:
+    try:
+        targets = target_datetimes(records.get("data"), records.get("range"))
+    except (ValueError, TypeError) as e:
+        return serialization.make_response({"errors": [f"could not parse target datetimes: {e}"]}, status=400)
+    if targets is None:
+        periods = int(records["size"])
+        target_spec = {"periods": periods}
+    else:
+        periods = len(targets)
+        target_spec = {"targets": sha1(targets.asi8.tobytes()).hexdigest()}
+    columns, uncertainty = _forecast_options(records)
+    try:
+        stream = streaming.stream_format(request, records)
+    except ValueError as e:
+        return serialization.make_response({"errors": [str(e)]}, status=400)
+    if stream is not None:
+        try:
+            m = get_model(model_id)
+        except FileNotFoundError:
+            return serialization.make_response({"errors": [f"unknown model {model_id}"]}, status=404)
+        future = m.make_future_dataframe(periods=periods) if targets is None else pd.DataFrame({"ds": targets})
+        app.logger.info(f"model_server version = {__version__} model_id = {model_id} streaming {len(future)} rows")
+        try:
+            return streaming.stream_predictions(lambda block: forecast_frame(m, block, uncertainty, columns),
+                                                future, stream, headers=[("X-Model-Id", model_id)])
+        except ValueError as e:
+            return serialization.make_response({"errors": [str(e)]}, status=400)
+    fmt = serialization.response_format(request)
+    key = forecast_cache.forecast_key(model_id, columns=columns, uncertainty=uncertainty, fmt=fmt, **target_spec)
+    cached = forecast_cache.get(model_id, key)
+    if cached is not None:
+        app.logger.info(f"model_server version = {__version__} model_id = {model_id} cached {periods} periods")
+        return serialization.body_response(*cached)
+    try:
+        m = get_model(model_id)
+    except FileNotFoundError:
+        return serialization.make_response({"errors": [f"unknown model {model_id}"]}, status=404)
+    if targets is None:
         future = m.make_future_dataframe(periods=periods)
-    forecast = m.predict(future)
-    rdata = json.dumps({
+    else:
+        future = pd.DataFrame({"ds": targets})
+    try:
+        forecast = forecast_frame(m, future, uncertainty, columns)
+    except ValueError as e:
+        return serialization.make_response({"errors": [str(e)]}, status=400)
+    res = {
         "size": forecast.shape,
-        "data": forecast.to_numpy(),
+        "data": forecast,
         "header": forecast.columns,
         "model_id": model_id
-    }, cls=NumpyArrayEncoder)
+    }
     app.logger.info(f"model_server version = {__version__} model_id = {model_id} predicted {periods} periods")
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+    rdata, content_type, headers = serialization.encode_body(res, fmt)
+    forecast_cache.put(model_id, key, rdata, content_type, headers)
+    return serialization.body_response(rdata, content_type, headers)
+
+
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch():
+    """
+    Forecasts of many models in one table, e.g. the models returned by /train/batch.
+    JSON Post Payload:
+    { "size": 4,  (periods to forecast past each model's history)
+      "models": {"name1": model_id1, "name2": model_id2, ...},
+      "columns": ["ds", "yhat"],  (optional, as for /predict)
+      "uncertainty": false  (optional, as for /predict)
+    }
+    :return: {"data": rows of series, ds, yhat, ..., "header": [...],
+        "index": {"name1": [first row, end row], ...}, "errors": {...}};
+        with Accept: application/vnd.apache.arrow.stream the rows come as one Arrow table
+    """
+    # models is a mapping, only JSON and MessagePack can carry it
+    records = serialization.decode_request(request, formats=[serialization.JSON, serialization.MSGPACK])
+    periods = int(records["size"])
+    models = records.get("models")
+    if not isinstance(models, dict) or len(models) == 0:
+        return serialization.make_response({"errors": ['"models" should map series names to model ids']},
+                                           status=400)
+    columns, uncertainty = _forecast_options(records)
+    try:
+        forecasts, errors = batch.forecast_models(models, periods, uncertainty, columns)
+    except ValueError as e:
+        return serialization.make_response({"errors": [str(e)]}, status=400)
+    if len(forecasts) == 0:
+        return serialization.make_response({"errors": errors}, status=404)
+    frame, index = batch.concat_forecasts(forecasts)
+    res = {
+        "size": frame.shape,
+        "data": frame,
+        "header": frame.columns,
+        "index": index,
+        "errors": errors
+    }
+    app.logger.info(f"model_server version = {__version__} predicted {periods} periods for {len(forecasts)} series")
+    return serialization.make_response(res, serialization.response_format(request))
 
 
 @app.route('/validation/<model_id>')
 def validation(model_id):
     """
+    Optional query parameters:
+        initial, period, horizon   cutoff configuration (default 2090 days, 365 days, 365 days)
+        parallel                   processes or threads to fan the cutoffs out (default serial)
+        workers                    size of the pool (default CV_WORKERS or the cpu count)
+        refresh                    true to recompute metrics stored for this configuration
     :return:
     """
-    m = get_model(model_id)
+    try:
+        cv, parallel, workers = model_validation.cv_parameters(request.args)
+    except ValueError as e:
+        return serialization.make_response({"errors": [str(e)]}, status=400)
+    stored = None
+    if request.args.get("refresh", "false").lower() not in ("1", "true"):
+        stored = get_metrics(model_id, cv)
+    if stored is not None:
+        res = {"data": stored["data"], "training_time": stored["validation_time"], "model_id": model_id,
+               "parameters": cv, "cached": True}
+        app.logger.info(f"model_server version = {__version__} model_id = {model_id} cross-validation from store")
+        return serialization.make_response(res)
+    try:
+        m = get_model(model_id)
+    except FileNotFoundError:
+        return serialization.make_response({"errors": [f"unknown model {model_id}"]}, status=404)
     start_time = time.time()
-    df_cv = cross_validation(m, initial='2090 days', period='365 days', horizon='365 days')
-    df_p = performance_metrics(df_cv)
+    try:
+        df_p = model_validation.cross_validate(m, parallel=parallel, workers=workers, **cv)
+    except ValueError as e:  # e.g. too little history for the cutoffs
+        return serialization.make_response({"errors": [str(e)]}, status=400)
     train_time = time.time() - start_time
-    rdata = json.dumps({"data": "XJSONX", "training_time": train_time, "model_id": model_id})
-    rdata = rdata.replace('"XJSONX"', df_p.to_json())
-    app.logger.info(f"model_server version = {__version__} model_id = {model_id} cross-validation in {train_time} s")
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+    persist_metrics(model_id, cv, df_p, train_time)
+    res = {"data": json.loads(df_p.to_json()), "training_time": train_time, "model_id": model_id,
+           "parameters": dict(cv, parallel=parallel, workers=workers if parallel else 1), "cached": False}
+    app.logger.info(f"model_server version = {__version__} model_id = {model_id} cross-validation in {train_time} s"
+                    f" (parallel = {parallel})")
+    return serialization.make_response(res)
+
+
+@app.route('/cache')
+def cache():
+    """
+    Model and forecast cache sizes and hit/miss/eviction counters of this worker
+    """
+    return serialization.make_response({
+        "models": model_cache.stats(),
+        "forecasts": forecast_cache.cache.stats()})
+
+
+# encoded /example body, the example data does not change while the worker runs
+_example_body = None
 
 
 @app.route('/example')
 def example():
-    d, h = get_training_data()
-    rdata = json.dumps({
-        "size": d.shape,
-        "data": d,
-        "header": h}, cls=NumpyArrayEncoder)
-    response_headers = [
-        ('Content-type', 'application/json'),
-        ('Content-Length', str(len(rdata)))
-    ]
-    return Response(response=rdata, status=200, headers=response_headers)
+    """
+    Query parameters: stream=ndjson or csv (or the matching Accept header) sends the rows in blocks
+    """
+    global _example_body
+    try:
+        stream = streaming.stream_format(request)
+    except ValueError as e:
+        return serialization.make_response({"errors": [str(e)]}, status=400)
+    if stream is not None:
+        d, h = get_training_data()
+        return streaming.stream_rows(d, h, stream)
+    if _example_body is None:
+        d, h = get_training_data()
+        _example_body = serialization.encode_body({
+            "size": d.shape,
+            "data": d,
+            "header": h})
+    return serialization.body_response(*_example_body)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pandas as pd
+from prophet.diagnostics import cross_validation, performance_metrics
+
+default_cv_parameters = {"initial": "2090 days", "period": "365 days", "horizon": "365 days"}
+parallel_modes = ["processes", "threads"]
+# default fan-out when the caller asks for parallel without a worker count
+default_cv_workers = int(os.getenv("CV_WORKERS", str(os.cpu_count() or 1)))
+
+
+def cv_parameters(args):
+    """
+    :param args: request parameters (initial, period, horizon, parallel, workers)
+    :return: cutoff configuration, parallel mode (None is serial), worker count
+    :raises ValueError: unparseable duration, unknown parallel mode or bad worker count
+    """
+    cv = {k: args.get(k, v) for k, v in default_cv_parameters.items()}
+    for k, v in cv.items():
+        try:
+            pd.Timedelta(v)
+        except ValueError as e:
+            raise ValueError(f"{k} should be a duration like 365 days, got {v}") from e
+    parallel = args.get("parallel") or None
+    if parallel is not None and parallel not in parallel_modes:
+        raise ValueError(f"parallel should be one of {parallel_modes}, got {parallel}")
+    workers = int(args.get("workers", default_cv_workers))
+    if workers < 1:
+        raise ValueError(f"workers should be at least 1, got {workers}")
+    return cv, parallel, workers
+
+
+def cross_validate(m, initial, period, horizon, parallel=None, workers=default_cv_workers):
+    """
+    Prophet cross validation with the cutoffs fanned out over a pool
+    :param parallel: None (serial), "processes" or "threads"
+    :return: performance metrics DataFrame
+    """
+    if parallel is None:
+        df_cv = cross_validation(m, initial=initial, period=period, horizon=horizon)
+    else:
+        if parallel == "processes":
+            # fork rather than Prophet's forkserver default, which cannot start from uWSGI
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        with pool:
+            df_cv = cross_validation(m, initial=initial, period=period, horizon=horizon, parallel=pool)
+    return performance_metrics(df_cv)
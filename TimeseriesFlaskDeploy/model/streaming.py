@@ -0,0 +1,99 @@
+"""
+Streamed responses for large forecasts and the example data.
+
+Asked for with Accept: application/x-ndjson (one JSON object per row) or text/csv
+(a header line, then rows), or "stream": "ndjson" / "csv" in the request. Rows are
+produced, encoded and sent a block at a time, so a worker never holds the whole body.
+"""
+import itertools
+import os
+
+import pandas as pd
+from flask import Response, stream_with_context
+
+import serialization
+
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+stream_formats = {"ndjson": NDJSON, "csv": CSV}
+
+# rows predicted and encoded per block
+chunk_rows = int(os.getenv("STREAM_CHUNK_ROWS", "500"))
+
+
+def stream_format(req, records=None):
+    """
+    :return: NDJSON or CSV when the client asked for a stream, otherwise None
+    """
+    stream = (records or {}).get("stream", req.args.get("stream"))
+    if stream is not None:
+        if stream not in stream_formats:
+            raise ValueError(f"stream should be one of {list(stream_formats)}")
+        return stream_formats[stream]
+    # only explicit Accept values, */* keeps the buffered formats
+    accepted = [mimetype for mimetype, _ in req.accept_mimetypes]
+    for fmt in (NDJSON, CSV):
+        if fmt in accepted:
+            return fmt
+    return None
+
+
+def encode_block(df, fmt, first=False):
+    """
+    :param df: pd.DataFrame block of the response
+    :param first: the block starts the body (CSV header line)
+    :return: encoded rows as bytes
+    """
+    if fmt == CSV:
+        return df.to_csv(header=first, index=False, date_format="%Y-%m-%d %H:%M:%S").encode("utf-8")
+    header = [str(c) for c in df.columns]
+    lines = [serialization.dumps(dict(zip(header, row))) for row in serialization.frame_rows(df)]
+    lines = [line.encode("utf-8") if isinstance(line, str) else line for line in lines]
+    return b"".join(line + b"\n" for line in lines)
+
+
+def blocks(frame, size=None):
+    """
+    :return: generator of row blocks of a pd.DataFrame or np.array
+    """
+    size = size or chunk_rows
+    for start in range(0, len(frame), size):
+        yield frame[start:start + size]
+
+
+def stream_response(frames, fmt, headers=()):
+    """
+    :param frames: iterable of pd.DataFrame blocks, produced lazily (e.g. predicted per block)
+    :return: chunked Response
+    """
+    def generate():
+        first = True
+        for df in frames:
+            yield encode_block(df, fmt, first)
+            first = False
+    return Response(stream_with_context(generate()), mimetype=fmt, headers=list(headers))
+
+
+def stream_predictions(predict, future, fmt, headers=()):
+    """
+    :param predict: function from a block of future to its forecast pd.DataFrame
+    :param future: pd.DataFrame with the ds to forecast
+    :return: chunked Response, each block is predicted just before it is sent;
+        ValueError for an empty future
+    """
+    future_blocks = blocks(future)
+    first_block = next(future_blocks, None)
+    if first_block is None:
+        raise ValueError("no datetimes to forecast")
+    # predicted before the response starts, so errors (e.g. unknown columns) can still be a 400
+    first = predict(first_block)
+    frames = itertools.chain([first], (predict(block) for block in future_blocks))
+    return stream_response(frames, fmt, headers)
+
+
+def stream_rows(data, header, fmt):
+    """
+    :param data: np.array of rows, e.g. from get_training_data
+    :return: chunked Response
+    """
+    return stream_response((pd.DataFrame(block, columns=header) for block in blocks(data)), fmt)
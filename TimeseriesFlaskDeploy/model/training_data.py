@@ -1,14 +1,17 @@
-import csv
+import copy
 import json
 import datetime
 import os
+import time
 
 
 import pandas as pd
 import numpy as np
 
-from joblib import dump, load
-from hashlib import sha512
+from hashlib import sha1, sha512
+
+import model_format
+from model_cache import LRUCache
 
 app_name = os.getenv("APP_NAME")
 if app_name == "TS-MODEL":
@@ -16,49 +19,292 @@ if app_name == "TS-MODEL":
 else:
     model_pickle_path = "../pickles/"  # path of outputs of training models
 
+# storage format of new models, see model_format.py
+model_storage_format = os.getenv("MODEL_FORMAT", "joblib")
+if model_storage_format not in model_format.available_formats():
+    raise ValueError(f"MODEL_FORMAT should be one of {model_format.available_formats()}, got {model_storage_format}")
+# loaded models kept per worker, sized by their uncompressed serialization
+model_cache = LRUCache(max_bytes=int(os.getenv("MODEL_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+                       ttl=float(os.getenv("MODEL_CACHE_TTL_SEC", "3600")))
+# seconds between recorded accesses (atime) of a model pickle
+access_time_resolution = 600
+
+# "columns": "forecast" in /predict, the point forecast and its interval
+forecast_columns = ["ds", "yhat", "yhat_lower", "yhat_upper"]
+
 example_data_file_path = "../data/"  # relative to python package
 data_filename = example_data_file_path + "example_wp_log_peyton_manning.csv"
+# typed columns of the example data, see training_columns
+example_columns_file = os.getenv("EXAMPLE_COLUMNS_FILE", example_data_file_path + "example_wp_log_peyton_manning.npy")
+
+
+_training_columns = None
+_training_rows = None
+
+
+def training_columns():
+    """
+    The example data as typed columns, parsed once per process.
+    The array is persisted to example_columns_file and memory-mapped so workers share the pages.
+    :return: structured np.array with fields ds (datetime64[ns]) and y (float64)
+    """
+    global _training_columns
+    if _training_columns is None:
+        if os.path.exists(example_columns_file) and \
+                os.path.getmtime(example_columns_file) >= os.path.getmtime(data_filename):
+            _training_columns = np.load(example_columns_file, mmap_mode="r")
+        else:
+            df = pd.read_csv(data_filename)
+            arr = np.empty(len(df), dtype=[("ds", "datetime64[ns]"), ("y", np.float64)])
+            arr["ds"] = pd.to_datetime(df["ds"]).to_numpy(dtype="datetime64[ns]")
+            arr["y"] = df["y"].to_numpy(dtype=np.float64)
+            try:
+                np.save(example_columns_file, arr)
+                arr = np.load(example_columns_file, mmap_mode="r")
+            except OSError:
+                pass  # read only data directory, keep the private copy
+            _training_columns = arr
+    return _training_columns
 
 
 def get_training_data():
-    with open(data_filename, "r") as infile:
-        rdr = csv.reader(infile)
-        first = True
-        data = []
-        for r in rdr:
-            if first:
-                header = r
-                first = False
-            else:
-                data.append(r)
-        data = np.array(data)
-        return data, header
-
-
-def persist_model(model):
+    """
+    :return: rows of the example data as strings (as in the csv file), header
+    """
+    global _training_rows
+    if _training_rows is None:
+        arr = training_columns()
+        ds = arr["ds"]
+        if (ds == ds.astype("datetime64[D]")).all():
+            ds = np.datetime_as_string(ds, unit="D")
+        else:
+            ds = np.char.replace(np.datetime_as_string(ds, unit="s"), "T", " ")
+        _training_rows = np.column_stack([ds, arr["y"].astype(str)])
+    return _training_rows, ["ds", "y"]
+
+
+def training_frame(data):
+    """
+    :param data: [[ds, y], ...] rows, a structured np.array or a pd.DataFrame with ds and y columns
+    :return: pd.DataFrame with columns ds, y
+    """
+    if isinstance(data, pd.DataFrame):
+        return data[['ds', 'y']]
+    elif isinstance(data, np.ndarray) and data.dtype.names is not None:
+        return pd.DataFrame(data)[['ds', 'y']]
+    return pd.DataFrame(np.array(data), columns=['ds', 'y'])
+
+
+def merge_history(model, data):
+    """
+    :param model: fitted Prophet model
+    :param data: new rows, anything training_frame accepts
+    :return: pd.DataFrame with columns ds, y of the model's history plus the new rows,
+        a new row replaces the history row with the same ds
+    """
+    df = training_frame(data)
+    df = df.assign(ds=pd.to_datetime(df["ds"]), y=pd.to_numeric(df["y"]))
+    merged = pd.concat([model.history[["ds", "y"]], df], ignore_index=True)
+    merged = merged.drop_duplicates(subset="ds", keep="last")
+    return merged.sort_values("ds").reset_index(drop=True)
+
+
+def new_model_id():
     _tmp_string = "time_series_model" + str(datetime.datetime.now())
-    model_id = sha512(_tmp_string.encode("ascii", errors="ignore")).hexdigest()[:40]
+    return sha512(_tmp_string.encode("ascii", errors="ignore")).hexdigest()[:40]
+
+
+def model_id_for(df, params=None):
+    """
+    Content address of a model: the same training data (in any row order) and the same
+    Prophet hyperparameters always give the same model_id
+    :param df: pd.DataFrame with columns ds, y
+    :param params: keyword arguments for Prophet()
+    """
+    ds = pd.to_datetime(df["ds"]).to_numpy(dtype="datetime64[ns]").view(np.int64)
+    y = pd.to_numeric(df["y"]).to_numpy(dtype=np.float64)
+    order = np.lexsort((y, ds))
+    h = sha512(b"time_series_model")
+    h.update(json.dumps(params or {}, sort_keys=True).encode("utf-8"))
+    h.update(ds[order].tobytes())
+    h.update(y[order].tobytes())
+    return h.hexdigest()[:40]
+
+
+def model_file_name(model_id):
+    """
+    :return: file name of the stored model in whichever format it was saved, None if there is none
+    """
+    for fmt in [model_storage_format] + [f for f in model_format.extensions if f != model_storage_format]:
+        file_name = model_pickle_path + model_id + model_format.extensions[fmt]
+        if os.path.exists(file_name):
+            return file_name
+    return None
+
+
+def model_exists(model_id):
+    return model_file_name(model_id) is not None
+
+
+def persist_model(model, model_id=None, fmt=None):
+    """
+    :param fmt: storage format (see model_format.py), default MODEL_FORMAT
+    :return: model_id
+    """
+    if model_id is None:
+        model_id = new_model_id()
     # save the model for later use
-    dump(model, filename=model_pickle_path + model_id + ".pkl")
+    model_format.dump_model(model, model_pickle_path + model_id, fmt or model_storage_format)
     return model_id
 
 
+def _params_file_name(model_id):
+    return model_pickle_path + f"{model_id}.params.json"
+
+
+def persist_params(model_id, params):
+    """
+    Save the Prophet hyperparameters a model was fit with next to the model
+    """
+    file_name = _params_file_name(model_id)
+    tmp_file_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(tmp_file_name, "w") as outfile:
+        json.dump(params or {}, outfile)
+    os.replace(tmp_file_name, file_name)
+
+
+def get_params(model_id):
+    """
+    :return: the keyword arguments for Prophet() the model was fit with,
+        None for models stored before these were recorded
+    """
+    try:
+        with open(_params_file_name(model_id), "r") as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return None
+
+
+def model_stamp(model_id):
+    """
+    :return: (mtime, size) of the model's file, identifies this version of the model;
+        counts as a use of the model, forecast cache hits never call get_model
+    """
+    file_name = model_file_name(model_id)
+    if file_name is None:
+        raise FileNotFoundError(f"no stored model {model_id}")
+    st = os.stat(file_name)
+    _record_access(file_name, st)
+    return st.st_mtime, st.st_size
+
+
+def _record_access(file_name, st):
+    # gc_models.py evicts by last use; keep mtime, it stamps the cached copies
+    now = time.time()
+    if now - st.st_atime > access_time_resolution:
+        try:
+            os.utime(file_name, (now, st.st_mtime))
+        except OSError:
+            pass
+
+
 def get_model(model_id):
-    model = load(model_pickle_path + model_id + ".pkl")
+    """
+    :return: the model, loaded at most once per worker while its file is unchanged
+    """
+    file_name = model_file_name(model_id)
+    if file_name is None:
+        raise FileNotFoundError(f"no stored model {model_id}")
+    st = os.stat(file_name)
+    stamp = (st.st_mtime, st.st_size)
+    _record_access(file_name, st)
+    model = model_cache.get(model_id, stamp)
+    if model is None:
+        model, nbytes = model_format.load_model_sized(file_name)
+        model_cache.put(model_id, model, nbytes, stamp)
     return model
 
 
-class NumpyArrayEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, pd.Timestamp):
-            return str(obj)
-        elif isinstance(obj, pd.Index):
-            return list(obj)
-        elif isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        else:
-            return super(NumpyArrayEncoder, self).default(obj)
+def target_datetimes(data=None, spec=None):
+    """
+    Datetimes to forecast, parsed in one vectorized call
+    :param data: [[datetime1], [datetime2], ...], a flat list, an np.array or a pd.DataFrame (ds or first column)
+    :param spec: {"start": ..., "end": ..., "periods": ..., "freq": "D"}, arguments of pd.date_range
+    :return: pd.DatetimeIndex, None when neither is given
+    """
+    if spec is not None:
+        if isinstance(spec, str):
+            spec = json.loads(spec)  # from the query string
+        unknown = set(spec) - {"start", "end", "periods", "freq"}
+        if len(unknown) > 0:
+            raise ValueError(f"unknown range fields {sorted(unknown)}")
+        ds = pd.date_range(**spec)
+        if len(ds) == 0:
+            raise ValueError("range has no datetimes")
+        return ds
+    if data is None or len(data) == 0:
+        return None
+    if isinstance(data, pd.DataFrame):
+        data = data["ds"] if "ds" in data.columns else data.iloc[:, 0]
+    data = np.asarray(data).ravel()
+    try:
+        # one vectorized parse, also for ISO strings of mixed precision ("2016-02-01", "2016-02-01 12:00")
+        ds = pd.to_datetime(data, format="ISO8601")
+    except ValueError:
+        ds = pd.to_datetime(data)
+    if ds.hasnans:
+        raise ValueError("missing target datetimes")
+    return ds
+
+
+def forecast_frame(model, future, uncertainty=True, columns=None):
+    """
+    :param future: pd.DataFrame with the ds to forecast
+    :param uncertainty: False skips the simulation draws of the intervals (no *_lower, *_upper columns)
+    :param columns: forecast columns to keep, a list or "forecast" for forecast_columns
+    :return: the forecast pd.DataFrame
+    """
+    if not uncertainty and model.uncertainty_samples:
+        # a shallow copy, the cached model is shared by the worker's threads
+        model = copy.copy(model)
+        model.uncertainty_samples = 0
+    forecast = model.predict(future)
+    if columns == "forecast":
+        columns = [c for c in forecast_columns if c in forecast.columns]
+    if columns is not None:
+        unknown = [c for c in columns if c not in forecast.columns]
+        if len(unknown) > 0:
+            raise ValueError(f"unknown forecast columns {unknown}")
+        forecast = forecast[columns]
+    return forecast
+
+
+def _metrics_file_name(model_id, cv):
+    # "365 days" and "365d" are the same cutoffs, key on the parsed durations
+    cv = {k: str(pd.Timedelta(v)) for k, v in cv.items()}
+    key = sha1(json.dumps(cv, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+    return model_pickle_path + f"{model_id}.cv-{key}.json"
+
+
+def persist_metrics(model_id, cv, df_p, validation_time):
+    """
+    Save cross validation performance metrics next to the model pickle
+    :param cv: cutoff configuration (initial, period, horizon) the metrics were computed with
+    """
+    record = {"cv": cv, "validation_time": validation_time, "data": json.loads(df_p.to_json())}
+    file_name = _metrics_file_name(model_id, cv)
+    tmp_file_name = f"{file_name}.{os.getpid()}.tmp"
+    with open(tmp_file_name, "w") as outfile:
+        json.dump(record, outfile)
+    os.replace(tmp_file_name, file_name)
+
+
+def get_metrics(model_id, cv):
+    """
+    :return: stored metrics record {"cv", "validation_time", "data"} or None
+    """
+    try:
+        with open(_metrics_file_name(model_id, cv), "r") as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return None